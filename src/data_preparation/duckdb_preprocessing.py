@@ -0,0 +1,160 @@
+import os
+
+import pandas as pd
+import numpy as np
+
+from data_preparation.generate_input_training_file import collect_input_datasets, finish_input_datasets, join_table
+from data_preparation.mimic_loading import cache_raw_table, chartevents_bucket_paths
+
+
+def _connect(settings: dict):
+    # Imported here so the pandas preprocessing does not need DuckDB installed
+    import duckdb
+
+    con = duckdb.connect()
+    if settings.get('memory_limit'):
+        con.execute(f"SET memory_limit='{settings['memory_limit']}'")
+    if settings.get('temp_directory'):
+        os.makedirs(settings['temp_directory'], exist_ok=True)
+        con.execute(f"SET temp_directory='{settings['temp_directory']}'")
+    if settings.get('threads'):
+        con.execute(f"SET threads TO {int(settings['threads'])}")
+    return con
+
+
+def _chartevents_sql(settings: dict) -> str:
+    """
+    Selects the chart events the pandas preprocessing would load through the
+    Chartevents catalog entry, with the rank of each event within its subject and
+    within its ICU stay (in file order).
+    """
+    bucket_files = ', '.join(
+        "'" + path.replace("'", "''") + "'"
+        for path in chartevents_bucket_paths(settings['cache_dir'], settings.get('subject_buckets'))
+    )
+    if settings.get('mode', 'stream') == 'stream':
+        loaded = f"""
+            SELECT * FROM (
+                SELECT SUBJECT_ID, ICUSTAY_ID, CHARTTIME, ITEMID, VALUE, VALUEUOM, FILE_ROW,
+                    row_number() OVER (PARTITION BY SUBJECT_ID, ICUSTAY_ID ORDER BY FILE_ROW) AS stay_position
+                FROM read_parquet([{bucket_files}])
+                WHERE ICUSTAY_ID IN (SELECT ICUSTAY_ID FROM icustays)
+            ) WHERE stay_position <= {int(settings['events_per_stay'])}
+        """
+    else:
+        loaded = f"""
+            SELECT SUBJECT_ID, ICUSTAY_ID, CHARTTIME, ITEMID, VALUE, VALUEUOM, FILE_ROW
+            FROM read_parquet([{bucket_files}])
+            WHERE FILE_ROW < {int(settings['nrows'])}
+        """
+    return f"""
+        SELECT SUBJECT_ID, ICUSTAY_ID, CHARTTIME, ITEMID, VALUE, VALUEUOM, FILE_ROW,
+            row_number() OVER (PARTITION BY SUBJECT_ID ORDER BY FILE_ROW) - 1 AS _event_rank,
+            row_number() OVER (PARTITION BY SUBJECT_ID, ICUSTAY_ID ORDER BY FILE_ROW) - 1 AS _stay_rank
+        FROM ({loaded})
+    """
+
+
+def _dataset_flag_sql(dataset_spec: dict, subject_count: int) -> str:
+    """
+    The SQL equivalent of select_dataset_events for one dataset, over the ranked
+    chart events joined with each subject's _subject_order.
+    """
+    conditions = ['TRUE']
+    if 'events_per_stay' in dataset_spec:
+        conditions.append(f"_stay_rank < {int(dataset_spec['events_per_stay'])}")
+    if 'subject_splits' in dataset_spec:
+        subject_splits, events_per_tier = dataset_spec['subject_splits'], dataset_spec['events_per_tier']
+        if len(events_per_tier) != len(subject_splits) + 1:
+            raise ValueError(
+                f"Expected {len(subject_splits) + 1} tier sizes for {len(subject_splits)} splits, got {len(events_per_tier)}"
+            )
+        # Boundaries are rounded in Python as _subject_tier_mask does, SQL rounds halves differently
+        boundaries = [int(np.round(subject_count*split,0)) for split in subject_splits]
+        tiers = ' '.join(
+            f"WHEN _subject_order < {boundary} THEN {int(limit)}" for boundary, limit in zip(boundaries, events_per_tier)
+        )
+        conditions.append(f"_event_rank < CASE {tiers} ELSE {int(events_per_tier[-1])} END")
+    return ' AND '.join(conditions)
+
+
+def generate_input_datasets_duckdb(admissions: pd.DataFrame, patients: pd.DataFrame, icustays: pd.DataFrame, items: pd.DataFrame, dataset_tiers: dict, keyed_joins: bool, duckdb_preprocessing: dict, dataset_names: list) -> dict:
+    """
+    Builds the same input datasets as generate_input_datasets, but runs the chart
+    event selection, per-subject and per-stay head-k and the chart events join in DuckDB over
+    the Parquet cache of CHARTEVENTS. DuckDB spills to disk when a query does not
+    fit in memory_limit, so CHARTEVENTS is never loaded into pandas; only the
+    joined rows of the datasets are returned, which then go through the same date
+    jitter, filters and labels as the pandas path. Admissions, patients and ICU
+    stays (one row per stay) are small, so they are joined by join_table.
+
+    inputs:
+        - admissions, (preprocessed) patients, icustays and items
+        - dataset specs keyed by dataset name, from conf/base/parameters.yml
+        - join on the composite keys (see join_table)
+        - DuckDB settings from conf/base/parameters.yml: where CHARTEVENTS and its
+          Parquet cache are, how chart events are selected (as in the Chartevents
+          catalog entry) and the memory_limit, temp_directory and threads to use
+        - names of the datasets to build
+
+    returns:
+        - a dictionary of input tables keyed by dataset name
+    """
+    cache_raw_table(
+        duckdb_preprocessing['chartevents_filepath'],
+        duckdb_preprocessing['cache_dir'],
+        'chartevents',
+        duckdb_preprocessing.get('chartevents_buckets', 64),
+    )
+
+    table_one = join_table(admissions, patients, icustays, keyed_joins)
+    con = _connect(duckdb_preprocessing)
+    con.register('icustays', icustays[['ICUSTAY_ID']])
+    con.register('table_one', table_one.assign(_position=np.arange(len(table_one))))
+
+    con.execute(f"CREATE TEMP TABLE ranked_events AS {_chartevents_sql(duckdb_preprocessing)}")
+    subject_count = con.execute("SELECT count(DISTINCT SUBJECT_ID) FROM ranked_events").fetchone()[0]
+    print(f"Selected chart events for {subject_count} subjects in DuckDB")
+
+    dataset_flags = [
+        f"({_dataset_flag_sql(dataset_tiers[name], subject_count)}) AS _dataset_{dataset_index}"
+        for dataset_index, name in enumerate(dataset_names)
+    ]
+    used = ' OR '.join(f'_dataset_{dataset_index}' for dataset_index in range(len(dataset_names)))
+
+    event_columns = ['CHARTTIME', 'ITEMID', 'VALUE', 'VALUEUOM', '_event_rank'] + [
+        f'_dataset_{dataset_index}' for dataset_index in range(len(dataset_names))
+    ]
+    output_columns = list(table_one.columns) + event_columns
+
+    # Rows come back in the order a pandas merge leaves them in: grouped by ICU
+    # stay in order of first appearance in table one, then table one order, then
+    # chart events in file order
+    table_one = con.execute(f"""
+        WITH events AS (
+            SELECT * FROM (
+                SELECT r.*, {', '.join(dataset_flags)}
+                FROM ranked_events r
+                JOIN (
+                    SELECT SUBJECT_ID, row_number() OVER (ORDER BY min(FILE_ROW)) - 1 AS _subject_order
+                    FROM ranked_events GROUP BY SUBJECT_ID
+                ) s USING (SUBJECT_ID)
+            ) WHERE {used}
+        )
+        SELECT {', '.join(output_columns)} FROM (
+            SELECT {', '.join(f't.{column}' for column in table_one.columns)},
+                {', '.join(f'e.{column}' for column in event_columns)},
+                min(t._position) OVER (PARTITION BY t.SUBJECT_ID, t.ICUSTAY_ID) AS _stay_position,
+                t._position, e.FILE_ROW
+            FROM table_one t
+            JOIN events e ON e.SUBJECT_ID = t.SUBJECT_ID AND e.ICUSTAY_ID = t.ICUSTAY_ID
+        ) ORDER BY _stay_position, _position, FILE_ROW
+    """).fetchdf()
+    con.close()
+    # Missing strings come back as NaN from some DuckDB releases, as None from
+    # others and from the Parquet cache
+    strings = table_one[['VALUE', 'VALUEUOM']].astype(object)
+    table_one[['VALUE', 'VALUEUOM']] = strings.where(strings.notna(), None)
+    print(f"  with chart events (DuckDB): {table_one.shape[0]} rows")
+
+    return collect_input_datasets([finish_input_datasets(table_one, items, dataset_tiers, dataset_names)], dataset_names)
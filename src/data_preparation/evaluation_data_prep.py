@@ -35,11 +35,12 @@ def convert_time_features(
 ) -> dict:
     data = combine_data(real_data, synthetic_data)
     for column in time_features:
-        data[column] = data[column].apply(
-            lambda x: (pd.to_datetime(x, format="%Y-%m-%d %H:%M:%S").value)
-            if x is not np.nan
-            else np.nan
-        )
+        # Parsed as a whole column, missing times stay missing
+        times = pd.to_datetime(data[column], format="%Y-%m-%d %H:%M:%S")
+        if times.isna().any():
+            data[column] = np.where(times.isna(), np.nan, times.values.astype("int64"))
+        else:
+            data[column] = times.values.astype("int64")
     real_and_syn_data = uncombine_data(data)
     return real_and_syn_data
 
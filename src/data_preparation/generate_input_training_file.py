@@ -1,215 +1,396 @@
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
-from random import randrange, seed
-
-def load_mimic_data():
-    admissions = pd.read_csv('data/01_raw/admissions.csv.gz')
-    chartevents = pd.read_csv('data/01_raw/CHARTEVENTS.csv.gz',nrows=10000000)
-    icustays = pd.read_csv('data/01_raw/ICUSTAYS.csv.gz')
-    items = pd.read_csv('data/01_raw/D_ITEMS.csv.gz')
-    outputevents = pd.read_csv('data/01_raw/OUTPUTEVENTS.csv.gz')
-    patients = pd.read_csv('data/01_raw/PATIENTS.csv.gz')   
 
-    return admissions, chartevents, icustays, items, outputevents, patients
+from data_preparation.preprocessing_state import (
+    changed_subjects,
+    dataset_fingerprints,
+    dataset_signature,
+    load_dataset_state,
+    save_dataset_state,
+)
+from data_preparation.subject_random import (
+    ADMIT_DAYS_STREAM,
+    CHART_SECONDS_STREAM,
+    DISCH_DAYS_STREAM,
+    DOB_OFFSET_STREAM,
+    keyed_integers,
+    subject_shards,
+)
+
+AUGMENTATION_DATE = pd.Timestamp('2021-12-01 00:00:00')
+EARLIEST_REALISTIC_DOB = pd.Timestamp('1930-01-01 00:00:00')
+PREPROCESSING_SEED = 2021
+
+
+def _shift_years(dates: pd.Series, years: np.ndarray) -> pd.Series:
+    """
+    Adds a per-row number of calendar years to a datetime column, matching
+    ``pd.DateOffset(years=n)`` (29th February is clipped to the 28th) without
+    building an offset object per row.
+    """
+    values = dates.values.astype('datetime64[ns]')
+    days = values.astype('datetime64[D]')
+    months = values.astype('datetime64[M]')
+    month_of_year = (months - values.astype('datetime64[Y]').astype('datetime64[M]')).astype(np.int64)
+    day_of_month = (days - months.astype('datetime64[D]')).astype(np.int64)
+
+    new_years = values.astype('datetime64[Y]') + years.astype('timedelta64[Y]')
+    new_months = new_years.astype('datetime64[M]') + month_of_year.astype('timedelta64[M]')
+    month_length = ((new_months + 1).astype('datetime64[D]') - new_months.astype('datetime64[D]')).astype(np.int64)
+    new_days = new_months.astype('datetime64[D]') + np.minimum(day_of_month, month_length - 1).astype('timedelta64[D]')
+
+    time_of_day = values - days.astype('datetime64[ns]')
+    return pd.Series(new_days.astype('datetime64[ns]') + time_of_day, index=dates.index)
+
+
+def _year_ends_between(dobs: pd.Series):
+    """
+    Counts the year ends between each DOB and the augmentation date, as
+    ``len(pd.date_range(..., freq='Y'))`` would, using integer arithmetic on
+    the nanosecond values.
+
+    returns:
+        - year ends from DOB up to the augmentation date (DOBs in the past)
+        - year ends from the augmentation date up to DOB (DOBs in the future)
+    """
+    values = dobs.values.astype('datetime64[ns]')
+    year = values.astype('datetime64[Y]').astype(np.int64) + 1970
+    days = values.astype('datetime64[D]')
+    is_year_end = (days + 1).astype('datetime64[Y]').astype(np.int64) + 1970 != year
+    after_midnight = (values - days.astype('datetime64[ns]')).astype(np.int64) > 0
+
+    # date_range anchors year ends on the start's time of day, so a DOB late on
+    # 31st December only starts counting from the following year
+    behind = np.maximum(AUGMENTATION_DATE.year - year - (is_year_end & after_midnight), 0)
+    ahead = np.maximum(year - AUGMENTATION_DATE.year + is_year_end, 0)
+    behind[values > AUGMENTATION_DATE.to_datetime64()] = 0
+    ahead[values < AUGMENTATION_DATE.to_datetime64()] = 0
+    return behind, ahead
 
 
 def preproc_patients(patients: pd.DataFrame):
-    seed(2021)
     ## Augment patient DOBs
-    new_dobs = []
-    dob_offset = []
-    for index, row in patients.iterrows():
-        years_diff_behind = len(pd.date_range(start=pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S'),end=pd.to_datetime('2021-12-01 00:00:00',format='%Y-%m-%d %H:%M:%S'),freq='Y'))
-        years_diff_ahead = len(pd.date_range(start=pd.to_datetime('2021-12-01 00:00:00',format='%Y-%m-%d %H:%M:%S'),end=pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S'),freq='Y'))
-        
-        if (years_diff_behind != 0) and (pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S') < pd.to_datetime('1930-01-01 00:00:00',format='%Y-%m-%d %H:%M:%S')):
-            num_years = randrange(years_diff_behind - 80, years_diff_behind - 40)
-            new_dobs.append(pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S') + pd.DateOffset(years=num_years))     
-            dob_offset.append(num_years)
-        elif (years_diff_ahead != 0) and (pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S') > pd.to_datetime('2021-12-01 00:00:00',format='%Y-%m-%d %H:%M:%S')):
-            num_years = randrange(years_diff_ahead + 30, years_diff_ahead + 50)
-            new_dobs.append(pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S') - pd.DateOffset(years=num_years))
-            dob_offset.append(-num_years)
-        else:
-            new_dobs.append(pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S'))
-            dob_offset.append(0)
-    patients['DOB'] = new_dobs
-    patients['DOB_offset'] = dob_offset
-    return patients
+    dob = pd.to_datetime(patients['DOB'], format='%Y-%m-%d %H:%M:%S')
+    years_diff_behind, years_diff_ahead = _year_ends_between(dob)
 
-def join_table(admissions: pd.DataFrame, patients: pd.DataFrame, icustays: pd.DataFrame):
-    table_one = admissions[['ROW_ID','SUBJECT_ID','ETHNICITY','ADMITTIME','DISCHTIME','DISCHARGE_LOCATION']]
-    table_one = table_one.merge(patients[['SUBJECT_ID','GENDER','DOB']])
-    table_one = table_one.merge(icustays[['SUBJECT_ID','ICUSTAY_ID','FIRST_CAREUNIT']])
+    # DOBs shifted for patients over 89 are brought forward by 40-80 years,
+    # DOBs in the future are moved back by 30-50 years past the present day
+    move_forward = (years_diff_behind != 0) & (dob < EARLIEST_REALISTIC_DOB).values
+    move_back = (years_diff_ahead != 0) & (dob > AUGMENTATION_DATE).values
 
-    return table_one
-
-def generate_11k_dataset(admissions: pd.DataFrame, patients: pd.DataFrame, icustays: pd.DataFrame, chartevents: pd.DataFrame, items: pd.DataFrame):
-    seed(2021)
-    # Generate small input data file
-    table_one = join_table(admissions, patients, icustays)
-    one_per_pat = chartevents.drop_duplicates(subset=['SUBJECT_ID','ICUSTAY_ID'])
-    table_one = table_one.merge(one_per_pat[['SUBJECT_ID','ICUSTAY_ID','CHARTTIME','ITEMID','VALUE','VALUEUOM']],on=['SUBJECT_ID','ICUSTAY_ID'])
-
-    new_admits = []
-    new_dischs = []
-    new_chart = []
-
-    for index, row in table_one.iterrows():
-        admit_min = len(pd.date_range(start=pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S'),end=pd.to_datetime('2021-12-01 00:00:00',format='%Y-%m-%d %H:%M:%S'),freq='D'))
-        stay_len = len(pd.date_range(start=pd.to_datetime(row['ADMITTIME'],format='%Y-%m-%d %H:%M:%S'),end=pd.to_datetime(row['DISCHTIME'],format='%Y-%m-%d %H:%M:%S'),freq='S'))
-
-        num_days_admit = randrange(np.round(admit_min*0.25,0),np.round(admit_min*0.9,0)+5)
-        num_days_disch = randrange(0,50)
-        num_secs_chart = randrange(np.round(stay_len*0.01,0)+1,np.round(stay_len*0.99,0)+10)
-        new_admit_date = pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S') + pd.DateOffset(days=num_days_admit)
-        new_admits.append(new_admit_date)
-        new_dischs.append(new_admit_date + pd.DateOffset(days=num_days_disch))
-        new_chart.append(new_admit_date + pd.DateOffset(seconds=num_secs_chart))
-
-    table_one['ADMITTIME'] = new_admits
-    table_one['DISCHTIME'] = new_dischs
-    table_one['CHARTTIME'] = new_chart
-
-    table_one = table_one[(pd.to_datetime(table_one.ADMITTIME) < pd.to_datetime(table_one.CHARTTIME)) & (pd.to_datetime(table_one.DISCHTIME) > pd.to_datetime(table_one.CHARTTIME))]
-    table_one = table_one.merge(items[['ITEMID','LABEL']],on=['ITEMID'])
-    table_one.drop(['ICUSTAY_ID','ITEMID'],axis=1,inplace=True)
-    age_calc = pd.Timestamp('2021-12-01 00:00:00')
-    table_one['DOB'] = pd.to_datetime(table_one['DOB'], format='%Y-%m-%d %H:%M:%S')
-    table_one['age'] = (age_calc - table_one['DOB']).astype('<m8[Y]')
-    table_one = table_one.groupby('SUBJECT_ID').head(4)
-    print(f"Small input table saved, number of columns:  {table_one.shape[1]}, number of rows: {table_one.shape[0]}")
-    #table_one.to_csv(f'data/05_model_input/table_one_{table_one.shape[0]}.csv')
-    return table_one
+    low = np.select([move_forward, move_back], [years_diff_behind - 80, years_diff_ahead + 30], 0)
+    high = np.select([move_forward, move_back], [years_diff_behind - 40, years_diff_ahead + 50], 1)
+    num_years = keyed_integers(low, high, PREPROCESSING_SEED, DOB_OFFSET_STREAM, patients['SUBJECT_ID'])
+    dob_offset = np.select([move_forward, move_back], [num_years, -num_years], 0)
 
-def generate_81k_dataset(admissions: pd.DataFrame, patients: pd.DataFrame, icustays: pd.DataFrame, chartevents: pd.DataFrame, items: pd.DataFrame):
-    seed(2021)
-    # Generate mid-sized input file
-    table_one = join_table(admissions, patients, icustays)
-
-    total_subjects = list(chartevents.SUBJECT_ID.unique())
-
-    df_list = []
-
-    split_one = int(np.round(len(total_subjects)*0.3,0))
-    split_two = int(np.round(len(total_subjects)*0.9,0))
-
-    for sub_index in range(0,split_one):
-        search_id = total_subjects[sub_index]
-        df_list.append(chartevents[chartevents.SUBJECT_ID == int(search_id)].head(1))
-        
-    for sub_index in range(split_one,split_two):
-        search_id = total_subjects[sub_index]
-        df_list.append(chartevents[chartevents.SUBJECT_ID == int(search_id)].head(2))
-        
-    for sub_index in range(split_two,len(total_subjects)):
-        search_id = total_subjects[sub_index]
-        df_list.append(chartevents[chartevents.SUBJECT_ID == int(search_id)].head(100))
-
-    one_per_pat = pd.concat(df_list)
-    one_per_pat.shape
-
-    table_one = table_one.merge(one_per_pat[['SUBJECT_ID','ICUSTAY_ID','CHARTTIME','ITEMID','VALUE','VALUEUOM']],on=['SUBJECT_ID','ICUSTAY_ID'])
-
-    new_admits = []
-    new_dischs = []
-    new_chart = []
-
-    patient_stays = table_one[['SUBJECT_ID','ICUSTAY_ID','DOB','ADMITTIME']]
-    patient_stays.drop_duplicates(inplace=True)
-
-    for index, row in table_one.iterrows():
-        admit_min = len(pd.date_range(start=pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S'),end=pd.to_datetime('2021-12-01 00:00:00',format='%Y-%m-%d %H:%M:%S'),freq='D'))
-        stay_len = len(pd.date_range(start=pd.to_datetime(row['ADMITTIME'],format='%Y-%m-%d %H:%M:%S'),end=pd.to_datetime(row['DISCHTIME'],format='%Y-%m-%d %H:%M:%S'),freq='S'))
-
-        num_days_admit = randrange(np.round(admit_min*0.25,0),np.round(admit_min*0.9,0)+5)
-        num_days_disch = randrange(0,50)
-        num_secs_chart = randrange(np.round(stay_len*0.01,0)+1,np.round(stay_len*0.99,0)+10)
-        new_admit_date = pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S') + pd.DateOffset(days=num_days_admit)
-        new_admits.append(new_admit_date)
-        new_dischs.append(new_admit_date + pd.DateOffset(days=num_days_disch))
-        new_chart.append(new_admit_date + pd.DateOffset(seconds=num_secs_chart))
-
-    table_one['ADMITTIME'] = new_admits
-    table_one['DISCHTIME'] = new_dischs
-    table_one['CHARTTIME'] = new_chart
-
-    table_one = table_one[(pd.to_datetime(table_one.ADMITTIME) < pd.to_datetime(table_one.CHARTTIME)) & (pd.to_datetime(table_one.DISCHTIME) > pd.to_datetime(table_one.CHARTTIME))]
-    table_one = table_one.merge(items[['ITEMID','LABEL']],on=['ITEMID'])
-    table_one.drop(['ICUSTAY_ID','ITEMID'],axis=1,inplace=True)
-    age_calc = pd.Timestamp('2021-12-01 00:00:00')
-    table_one['DOB'] = pd.to_datetime(table_one['DOB'], format='%Y-%m-%d %H:%M:%S')
-    table_one['age'] = (age_calc - table_one['DOB']).astype('<m8[Y]')
-    print(f"Mid sized input table saved, number of columns:  {table_one.shape[1]}, number of rows: {table_one.shape[0]}")
-    #table_one.to_csv(f'data/05_model_input/table_one_imbalanced_{table_one.shape[0]}.csv')
-    return table_one
+    patients['DOB'] = _shift_years(dob, dob_offset)
+    patients['DOB_offset'] = dob_offset
+    return patients
 
-def generate_217k_dataset(admissions: pd.DataFrame, patients: pd.DataFrame, icustays: pd.DataFrame, chartevents: pd.DataFrame, items: pd.DataFrame):
-    seed(2021)
-    # Generate large-sized input file
-    table_one = join_table(admissions, patients, icustays)
-
-    total_subjects = list(chartevents.SUBJECT_ID.unique())
-
-    df_list = []
-
-    split_one = int(np.round(len(total_subjects)*0.3,0))
-    split_two = int(np.round(len(total_subjects)*0.7,0))
-
-    for sub_index in range(0,split_one):
-        search_id = total_subjects[sub_index]
-        df_list.append(chartevents[chartevents.SUBJECT_ID == int(search_id)].head(1))
-        
-    for sub_index in range(split_one,split_two):
-        search_id = total_subjects[sub_index]
-        df_list.append(chartevents[chartevents.SUBJECT_ID == int(search_id)].head(2))
-        
-    for sub_index in range(split_two,len(total_subjects)):
-        search_id = total_subjects[sub_index]
-        df_list.append(chartevents[chartevents.SUBJECT_ID == int(search_id)].head(100))
-
-    one_per_pat = pd.concat(df_list)
-    one_per_pat.shape
-
-    table_one = table_one.merge(one_per_pat[['SUBJECT_ID','ICUSTAY_ID','CHARTTIME','ITEMID','VALUE','VALUEUOM']],on=['SUBJECT_ID','ICUSTAY_ID'])
-
-    new_admits = []
-    new_dischs = []
-    new_chart = []
-
-    patient_stays = table_one[['SUBJECT_ID','ICUSTAY_ID','DOB','ADMITTIME']]
-    patient_stays.drop_duplicates(inplace=True)
-
-    for index, row in table_one.iterrows():
-        admit_min = len(pd.date_range(start=pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S'),end=pd.to_datetime('2021-12-01 00:00:00',format='%Y-%m-%d %H:%M:%S'),freq='D'))
-        stay_len = len(pd.date_range(start=pd.to_datetime(row['ADMITTIME'],format='%Y-%m-%d %H:%M:%S'),end=pd.to_datetime(row['DISCHTIME'],format='%Y-%m-%d %H:%M:%S'),freq='S'))
-
-        num_days_admit = randrange(np.round(admit_min*0.25,0),np.round(admit_min*0.9,0)+5)
-        num_days_disch = randrange(0,50)
-        num_secs_chart = randrange(np.round(stay_len*0.01,0)+1,np.round(stay_len*0.99,0)+10)
-        new_admit_date = pd.to_datetime(row['DOB'],format='%Y-%m-%d %H:%M:%S') + pd.DateOffset(days=num_days_admit)
-        new_admits.append(new_admit_date)
-        new_dischs.append(new_admit_date + pd.DateOffset(days=num_days_disch))
-        new_chart.append(new_admit_date + pd.DateOffset(seconds=num_secs_chart))
-
-    table_one['ADMITTIME'] = new_admits
-    table_one['DISCHTIME'] = new_dischs
-    table_one['CHARTTIME'] = new_chart
-
-    table_one = table_one[(pd.to_datetime(table_one.ADMITTIME) < pd.to_datetime(table_one.CHARTTIME)) & (pd.to_datetime(table_one.DISCHTIME) > pd.to_datetime(table_one.CHARTTIME))]
-    table_one = table_one.merge(items[['ITEMID','LABEL']],on=['ITEMID'])
-    table_one.drop(['ICUSTAY_ID','ITEMID'],axis=1,inplace=True)
-    age_calc = pd.Timestamp('2021-12-01 00:00:00')
-    table_one['DOB'] = pd.to_datetime(table_one['DOB'], format='%Y-%m-%d %H:%M:%S')
-    table_one['age'] = (age_calc - table_one['DOB']).astype('<m8[Y]')
-    print(f"Large input table saved, number of columns:  {table_one.shape[1]}, number of rows: {table_one.shape[0]}")
-    #table_one.to_csv(f'data/05_model_input/table_one_imbalanced_{table_one.shape[0]}.csv')
+def join_table(admissions: pd.DataFrame, patients: pd.DataFrame, icustays: pd.DataFrame, keyed_joins: bool = True):
+    """
+    Joins admissions, patients and ICU stays into one row per ICU stay.
+
+    Each ICU stay is matched to its own admission on (SUBJECT_ID, HADM_ID) and to
+    its patient through an index on SUBJECT_ID, so the table grows with the number
+    of stays. The original join on SUBJECT_ID alone pairs every admission of a
+    subject with every one of their ICU stays; it is kept behind keyed_joins=False
+    to reproduce the original input files.
+
+    inputs:
+        - admissions, (preprocessed) patients and icustays
+        - join on the composite keys rather than on SUBJECT_ID alone
+
+    returns:
+        - table one
+    """
+    table_one = admissions[['ROW_ID','SUBJECT_ID','HADM_ID','ETHNICITY','ADMITTIME','DISCHTIME','DISCHARGE_LOCATION']]
+    print(f"Joining tables, admissions: {table_one.shape[0]} rows")
+    if keyed_joins:
+        patient_index = patients.set_index('SUBJECT_ID')[['GENDER','DOB']]
+        table_one = table_one.join(patient_index, on='SUBJECT_ID', how='inner').reset_index(drop=True)
+        print(f"  with patients: {table_one.shape[0]} rows")
+        table_one = table_one.merge(
+            icustays[['SUBJECT_ID','HADM_ID','ICUSTAY_ID','FIRST_CAREUNIT']],
+            on=['SUBJECT_ID','HADM_ID'],
+            validate='one_to_many',
+        )
+    else:
+        table_one = table_one.merge(patients[['SUBJECT_ID','GENDER','DOB']])
+        print(f"  with patients: {table_one.shape[0]} rows")
+        table_one = table_one.merge(icustays[['SUBJECT_ID','ICUSTAY_ID','FIRST_CAREUNIT']])
+    print(f"  with ICU stays: {table_one.shape[0]} rows")
+
+    return table_one.drop('HADM_ID', axis=1)
+
+def jitter_stay_times(table_one: pd.DataFrame, seed: int) -> pd.DataFrame:
+    """
+    Moves ADMITTIME, DISCHTIME and CHARTTIME of every joined row so that they sit
+    after the (augmented) DOB and in a sensible order, working on whole columns.
+
+    The jitter of each row is drawn from its SUBJECT_ID, admission ROW_ID and the
+    rank of its chart event within the subject, so it does not depend on which
+    other rows are in the table.
+
+    inputs:
+        - table one, with SUBJECT_ID, ROW_ID, _event_rank, DOB, ADMITTIME and DISCHTIME columns
+        - seed the jitter is drawn from
+
+    returns:
+        - table one with new ADMITTIME, DISCHTIME and CHARTTIME columns
+    """
+    dob = pd.to_datetime(table_one['DOB'], format='%Y-%m-%d %H:%M:%S')
+    admit = pd.to_datetime(table_one['ADMITTIME'], format='%Y-%m-%d %H:%M:%S')
+    disch = pd.to_datetime(table_one['DISCHTIME'], format='%Y-%m-%d %H:%M:%S')
+
+    # Whole days from DOB to the augmentation date and whole seconds in the stay,
+    # counted inclusively as a daily/secondly pd.date_range between them would be
+    admit_min = np.maximum((AUGMENTATION_DATE - dob).values // np.timedelta64(1, 'D') + 1, 0)
+    stay_len = np.maximum((disch - admit).values // np.timedelta64(1, 's') + 1, 0)
+
+    row_keys = (table_one['SUBJECT_ID'], table_one['ROW_ID'], table_one['_event_rank'])
+    num_days_admit = keyed_integers(np.round(admit_min*0.25,0), np.round(admit_min*0.9,0)+5, seed, ADMIT_DAYS_STREAM, *row_keys)
+    num_days_disch = keyed_integers(0, 50, seed, DISCH_DAYS_STREAM, *row_keys)
+    num_secs_chart = keyed_integers(np.round(stay_len*0.01,0)+1, np.round(stay_len*0.99,0)+10, seed, CHART_SECONDS_STREAM, *row_keys)
+
+    new_admit_date = dob.values + num_days_admit.astype('timedelta64[D]')
+    table_one['ADMITTIME'] = new_admit_date
+    table_one['DISCHTIME'] = new_admit_date + num_days_disch.astype('timedelta64[D]')
+    table_one['CHARTTIME'] = new_admit_date + num_secs_chart.astype('timedelta64[s]')
     return table_one
 
-
-
-
-
-
-
-
+def _subject_tier_mask(chartevents: pd.DataFrame, subject_splits: tuple, events_per_tier: tuple) -> np.ndarray:
+    """
+    Marks the first few chart events of every subject, with the number kept
+    depending on which tier the subject falls in. Subjects are assigned to tiers in
+    order of first appearance, e.g. splits (0.3, 0.9) with events_per_tier
+    (1, 2, 100) keep 1 event for the first 30% of subjects, 2 for the next 60% and
+    up to 100 for the last 10%.
+    """
+    if len(events_per_tier) != len(subject_splits) + 1:
+        raise ValueError(
+            f"Expected {len(subject_splits) + 1} tier sizes for {len(subject_splits)} splits, got {len(events_per_tier)}"
+        )
+    subject_codes, subjects = pd.factorize(chartevents['SUBJECT_ID'])
+    boundaries = [int(np.round(len(subjects)*split,0)) for split in subject_splits]
+    subject_tier = np.searchsorted(boundaries, np.arange(len(subjects)), side='right')
+    subject_limit = np.asarray(events_per_tier)[subject_tier]
+
+    event_rank = chartevents.groupby('SUBJECT_ID', sort=False).cumcount().values
+    return event_rank < subject_limit[subject_codes]
+
+
+def select_dataset_events(chartevents: pd.DataFrame, dataset_spec: dict) -> np.ndarray:
+    """
+    Marks the chart events that go into one input dataset.
+
+    inputs:
+        - chartevents
+        - dataset spec from the dataset_tiers parameters, using any of
+          events_per_stay (first events of each subject and ICU stay) and
+          subject_splits with events_per_tier (see _subject_tier_mask)
+
+    returns:
+        - boolean mask over the rows of chartevents
+    """
+    keep = np.ones(len(chartevents), dtype=bool)
+    if 'events_per_stay' in dataset_spec:
+        stay_rank = chartevents.groupby(['SUBJECT_ID','ICUSTAY_ID'], sort=False, dropna=False).cumcount().values
+        keep &= stay_rank < dataset_spec['events_per_stay']
+    if 'subject_splits' in dataset_spec:
+        keep &= _subject_tier_mask(chartevents, dataset_spec['subject_splits'], dataset_spec['events_per_tier'])
+    return keep
+
+
+def finish_input_datasets(table_one: pd.DataFrame, items: pd.DataFrame, dataset_tiers: dict, dataset_names: list) -> dict:
+    """
+    Runs the stages after the chart events merge (date jitter, time filters,
+    labels, age and the per-subject row cap) and splits the result into datasets.
+
+    inputs:
+        - table one joined with chart events, with _event_rank and one
+          _dataset_<i> flag per dataset
+        - items
+        - dataset specs keyed by dataset name
+        - names of the datasets to build
+
+    returns:
+        - a dictionary of input tables keyed by dataset name
+    """
+    table_one = jitter_stay_times(table_one, PREPROCESSING_SEED)
+    table_one = table_one[(table_one.ADMITTIME < table_one.CHARTTIME) & (table_one.DISCHTIME > table_one.CHARTTIME)]
+
+    # Labels are looked up rather than merged so rows keep their order within each
+    # subject whatever other subjects are in the shard. The merge regrouped rows by
+    # ITEMID, so rows_per_subject kept different rows in the original input files
+    labels = items.set_index('ITEMID')['LABEL']
+    table_one = table_one[table_one['ITEMID'].isin(labels.index)].assign(LABEL=lambda t: t['ITEMID'].map(labels))
+
+    dataset_flags = [f'_dataset_{dataset_index}' for dataset_index in range(len(dataset_names))]
+    datasets = {}
+    for flag, name in zip(dataset_flags, dataset_names):
+        dataset = table_one[table_one[flag]].drop(dataset_flags + ['_event_rank','ICUSTAY_ID','ITEMID'], axis=1)
+        dataset['DOB'] = pd.to_datetime(dataset['DOB'], format='%Y-%m-%d %H:%M:%S')
+        dataset['age'] = (AUGMENTATION_DATE - dataset['DOB']).astype('<m8[Y]')
+        if 'rows_per_subject' in dataset_tiers[name]:
+            dataset = dataset.groupby('SUBJECT_ID').head(dataset_tiers[name]['rows_per_subject'])
+        datasets[name] = dataset
+    return datasets
+
+
+def build_subject_shard(admissions: pd.DataFrame, patients: pd.DataFrame, icustays: pd.DataFrame, events: pd.DataFrame, items: pd.DataFrame, dataset_tiers: dict, dataset_names: list, keyed_joins: bool = True) -> dict:
+    """
+    Runs the per-subject stages of generate_input_datasets (joins, then
+    finish_input_datasets) for one set of subjects.
+
+    inputs:
+        - admissions, (preprocessed) patients, icustays and items
+        - chart events used by any of the datasets, with one _dataset_<i> flag per dataset
+        - dataset specs keyed by dataset name
+        - names of the datasets to build
+        - join on the composite keys (see join_table)
+
+    returns:
+        - a dictionary of input tables for these subjects keyed by dataset name
+    """
+    table_one = join_table(admissions, patients, icustays, keyed_joins)
+    table_one = table_one.merge(events, on=['SUBJECT_ID','ICUSTAY_ID'])
+    print(f"  with chart events: {table_one.shape[0]} rows")
+    return finish_input_datasets(table_one, items, dataset_tiers, dataset_names)
+
+
+def collect_input_datasets(shards: list, dataset_names: list) -> dict:
+    """
+    Concatenates the datasets built for each set of subjects, sorted by SUBJECT_ID.
+    Shards without rows are left out, as their columns can come out of the joins in
+    a different order.
+    """
+    datasets = {}
+    for name in dataset_names:
+        parts = [shard[name] for shard in shards if len(shard[name])] or [shards[0][name]]
+        dataset = pd.concat(parts)
+        dataset = dataset.sort_values('SUBJECT_ID', kind='mergesort').reset_index(drop=True)
+        print(f"{name} input table built, number of columns:  {dataset.shape[1]}, number of rows: {dataset.shape[0]}")
+        datasets[name] = dataset
+    return datasets
+
+
+def build_shards(tables: list, items: pd.DataFrame, dataset_tiers: dict, dataset_names: list, keyed_joins: bool, preprocessing_workers: int) -> list:
+    """
+    Runs build_subject_shard over the admissions, patients, icustays and events
+    tables, in this process or split by a hash of SUBJECT_ID (see subject_shards)
+    across worker processes.
+
+    returns:
+        - one dictionary of input tables keyed by dataset name per shard
+    """
+    if preprocessing_workers <= 1:
+        return [build_subject_shard(*tables, items, dataset_tiers, dataset_names, keyed_joins)]
+    with ProcessPoolExecutor(max_workers=preprocessing_workers) as executor:
+        table_shards = [subject_shards(table['SUBJECT_ID'].values, preprocessing_workers) for table in tables]
+        futures = []
+        for shard in range(preprocessing_workers):
+            shard_tables = [table[shards == shard] for table, shards in zip(tables, table_shards)]
+            futures.append(executor.submit(build_subject_shard, *shard_tables, items, dataset_tiers, dataset_names, keyed_joins))
+        return [future.result() for future in futures]
+
+
+def build_incrementally(tables: list, items: pd.DataFrame, dataset_tiers: dict, dataset_names: list, keyed_joins: bool, preprocessing_workers: int, state_dir: str) -> dict:
+    """
+    Rebuilds only the subjects whose rows changed since the last build and merges
+    them into the datasets saved then. Every per-subject stage is keyed on the
+    subject alone and rows are sorted by SUBJECT_ID, so the result is the same as
+    building every subject again.
+
+    A subject is rebuilt when their admissions, patients or ICU stay rows, or the
+    chart events selected for them in any of the datasets, differ from the last
+    build (including a change of tier as subjects are added). Every subject is
+    rebuilt when a dataset's spec, keyed_joins or the items change.
+
+    inputs:
+        - admissions, (preprocessed) patients, icustays and events (as in build_shards)
+        - items
+        - dataset specs keyed by dataset name
+        - names of the datasets to build
+        - join on the composite keys (see join_table)
+        - number of worker processes
+        - directory the datasets and subject fingerprints are saved in between builds
+
+    returns:
+        - a dictionary of input tables keyed by dataset name
+    """
+    *raw_tables, events = tables
+    dataset_flags = [f'_dataset_{dataset_index}' for dataset_index in range(len(dataset_names))]
+    signatures, fingerprints, previous = {}, {}, {}
+    rebuild = pd.Index([])
+    for flag, name in zip(dataset_flags, dataset_names):
+        signatures[name] = dataset_signature(dataset_tiers[name], keyed_joins, PREPROCESSING_SEED, items)
+        fingerprints[name] = dataset_fingerprints(raw_tables, events[events[flag]].drop(dataset_flags, axis=1))
+        previous[name] = load_dataset_state(state_dir, name, signatures[name])
+        if previous[name] is None:
+            rebuild = rebuild.union(fingerprints[name].index)
+        else:
+            rebuild = rebuild.union(changed_subjects(fingerprints[name], previous[name][1]))
+
+    print(f"Rebuilding {len(rebuild)} subjects")
+    rebuild_tables = [table[table['SUBJECT_ID'].isin(rebuild)] for table in tables]
+    shards = build_shards(rebuild_tables, items, dataset_tiers, dataset_names, keyed_joins, preprocessing_workers)
+
+    # Rows of subjects that are unchanged are kept, subjects that are gone are dropped
+    kept = {}
+    for name in dataset_names:
+        if previous[name] is None:
+            kept[name] = shards[0][name].iloc[:0]
+            continue
+        dataset = previous[name][0]
+        keep = dataset['SUBJECT_ID'].isin(fingerprints[name].index) & ~dataset['SUBJECT_ID'].isin(rebuild)
+        kept[name] = dataset[keep]
+
+    datasets = collect_input_datasets([kept] + shards, dataset_names)
+    for name in dataset_names:
+        save_dataset_state(state_dir, name, signatures[name], datasets[name], fingerprints[name])
+    return datasets
+
+
+def generate_input_datasets(admissions: pd.DataFrame, patients: pd.DataFrame, icustays: pd.DataFrame, chartevents: pd.DataFrame, items: pd.DataFrame, dataset_tiers: dict, preprocessing_workers: int, keyed_joins: bool, incremental_preprocessing: dict, dataset_names: list) -> dict:
+    """
+    Builds several input datasets of different sizes in one pass. The tables are
+    joined, merged with the chart events any of the datasets use and jittered once,
+    then each dataset takes its own rows from the shared table.
+
+    With more than one worker, subjects are hash-partitioned (see subject_shards)
+    and each partition is built in its own process. All random
+    draws are keyed on SUBJECT_ID and rows are returned sorted by SUBJECT_ID, so
+    the output is the same for any number of workers.
+
+    inputs:
+        - admissions, (preprocessed) patients, icustays, chartevents and items
+        - dataset specs keyed by dataset name, from conf/base/parameters.yml
+        - number of worker processes, 1 builds everything in this process
+        - join on the composite keys (see join_table)
+        - incremental build settings, only changed subjects are rebuilt when
+          enabled (see build_incrementally)
+        - names of the datasets to build
+
+    returns:
+        - a dictionary of input tables keyed by dataset name
+    """
+    # Tiers depend on the order subjects first appear in, so events are selected
+    # over the whole of chartevents before subjects are split up
+    event_masks = {name: select_dataset_events(chartevents, dataset_tiers[name]) for name in dataset_names}
+    used = np.logical_or.reduce(list(event_masks.values()))
+    event_rank = chartevents.groupby('SUBJECT_ID', sort=False).cumcount().values
+    events = chartevents.loc[used, ['SUBJECT_ID','ICUSTAY_ID','CHARTTIME','ITEMID','VALUE','VALUEUOM']].copy()
+    events['_event_rank'] = event_rank[used]
+    for dataset_index, name in enumerate(dataset_names):
+        events[f'_dataset_{dataset_index}'] = event_masks[name][used]
+
+    tables = [admissions, patients, icustays, events]
+    if incremental_preprocessing.get('enabled', False):
+        return build_incrementally(
+            tables, items, dataset_tiers, dataset_names, keyed_joins, preprocessing_workers, incremental_preprocessing['state_dir']
+        )
+    shards = build_shards(tables, items, dataset_tiers, dataset_names, keyed_joins, preprocessing_workers)
+    return collect_input_datasets(shards, dataset_names)
@@ -0,0 +1,41 @@
+import os
+import shutil
+from contextlib import contextmanager
+
+
+@contextmanager
+def replace_directory(directory: str):
+    """
+    Writes a new version of a directory as one swap. Files are written to a
+    staging directory (``<directory>.tmp``), yielded to the caller. Once the
+    block finishes, the old directory is renamed aside (``<directory>.old``),
+    the staging directory renamed into its place, and only then is the old one
+    deleted. A crash before the swap leaves the old version in place. A crash
+    between the two renames leaves it at ``<directory>.old``, and the next write
+    restores it before staging. If the block raises, the staging directory is
+    removed and the old version kept.
+
+    inputs:
+        - directory to replace, created if it does not exist
+
+    returns:
+        - (yields) the staging directory to write the new version into
+    """
+    directory = directory.rstrip('/')
+    staging_dir = directory + '.tmp'
+    old_dir = directory + '.old'
+    if os.path.exists(old_dir) and not os.path.exists(directory):
+        os.rename(old_dir, directory)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    try:
+        yield staging_dir
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    if os.path.exists(directory):
+        os.rename(directory, old_dir)
+    os.rename(staging_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
@@ -0,0 +1,317 @@
+import json
+import os
+
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data_preparation.io_utils import replace_directory
+
+MIMIC_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+RAW_TABLE_FILES = {
+    'admissions': 'admissions.csv.gz',
+    'chartevents': 'CHARTEVENTS.csv.gz',
+    'icustays': 'ICUSTAYS.csv.gz',
+    'items': 'D_ITEMS.csv.gz',
+    'outputevents': 'OUTPUTEVENTS.csv.gz',
+    'patients': 'PATIENTS.csv.gz',
+}
+
+DATETIME_COLUMNS = {
+    'admissions': ['ADMITTIME', 'DISCHTIME', 'DEATHTIME', 'EDREGTIME', 'EDOUTTIME'],
+    'chartevents': ['CHARTTIME'],
+    'icustays': ['INTIME', 'OUTTIME'],
+    'outputevents': ['CHARTTIME', 'STORETIME'],
+    'patients': ['DOB', 'DOD', 'DOD_HOSP', 'DOD_SSN'],
+}
+
+# Only the CHARTEVENTS columns used to build the input files are read
+CHARTEVENTS_DTYPES = {
+    'SUBJECT_ID': 'int64',
+    'HADM_ID': 'float64',
+    'ICUSTAY_ID': 'float64',
+    'ITEMID': 'int64',
+    'CHARTTIME': 'object',
+    'VALUE': 'object',
+    'VALUEUOM': 'object',
+}
+
+# FILE_ROW records each event's position in CHARTEVENTS.csv.gz, so file order can be
+# restored after reading the SUBJECT_ID buckets back
+CHARTEVENTS_CACHE_SCHEMA = pa.schema([
+    ('SUBJECT_ID', pa.int64()),
+    ('HADM_ID', pa.float64()),
+    ('ICUSTAY_ID', pa.float64()),
+    ('ITEMID', pa.int64()),
+    ('CHARTTIME', pa.timestamp('ns')),
+    ('VALUE', pa.string()),
+    ('VALUEUOM', pa.string()),
+    ('FILE_ROW', pa.int64()),
+])
+
+
+def read_chartevents_head(filepath: str, nrows: int) -> pd.DataFrame:
+    """
+    Reads the first rows of CHARTEVENTS, as done before streaming was available.
+
+    inputs:
+        - path to CHARTEVENTS.csv.gz
+        - number of rows to read from the top of the file
+
+    returns:
+        - chartevents
+    """
+    return pd.read_csv(
+        filepath,
+        usecols=list(CHARTEVENTS_DTYPES),
+        dtype=CHARTEVENTS_DTYPES,
+        nrows=nrows,
+    )
+
+
+def stream_chartevents(
+    filepath: str,
+    icustay_ids: pd.Series = None,
+    events_per_stay: int = 100,
+    chunksize: int = 1000000,
+) -> pd.DataFrame:
+    """
+    Reads the whole of CHARTEVENTS in chunks, keeping only the first events of each
+    ICU stay so that memory is bounded by the chunk size and the number of stays
+    rather than the size of the file.
+
+    Events without an ICU stay (or for a stay not in icustay_ids) are dropped. The
+    count of events kept per stay is carried across chunk boundaries, so the result
+    is the same as taking ``groupby(['SUBJECT_ID', 'ICUSTAY_ID']).head(events_per_stay)``
+    over the full file, in file order.
+
+    inputs:
+        - path to CHARTEVENTS.csv.gz
+        - ICU stays to keep events for, all stays are kept when None
+        - maximum number of events kept per subject and ICU stay
+        - number of rows parsed at a time
+
+    returns:
+        - chartevents
+    """
+    if icustay_ids is not None:
+        icustay_ids = pd.unique(np.asarray(icustay_ids, dtype='float64'))
+
+    # ICUSTAY_ID is unique across subjects, so it alone keys the running counts
+    kept_per_stay = pd.Series(dtype='int64')
+    kept_chunks = []
+
+    reader = pd.read_csv(
+        filepath,
+        usecols=list(CHARTEVENTS_DTYPES),
+        dtype=CHARTEVENTS_DTYPES,
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        chunk = chunk[chunk['ICUSTAY_ID'].notna()]
+        if icustay_ids is not None:
+            chunk = chunk[chunk['ICUSTAY_ID'].isin(icustay_ids)]
+
+        already_kept = kept_per_stay.reindex(chunk['ICUSTAY_ID'], fill_value=0).values
+        event_rank = chunk.groupby(['SUBJECT_ID', 'ICUSTAY_ID'], sort=False).cumcount().values
+        chunk = chunk[event_rank + already_kept < events_per_stay]
+
+        kept_per_stay = kept_per_stay.add(
+            chunk.groupby('ICUSTAY_ID').size(), fill_value=0
+        ).astype('int64')
+        kept_chunks.append(chunk)
+
+    chartevents = pd.concat(kept_chunks, ignore_index=True)
+    chartevents['ICUSTAY_ID'] = chartevents['ICUSTAY_ID'].astype('int64')
+    print(f"Streamed chartevents for {len(kept_per_stay)} ICU stays, number of rows: {chartevents.shape[0]}")
+    return chartevents
+
+
+def _source_signature(filepath: str) -> dict:
+    stat = os.stat(filepath)
+    return {'source': os.path.basename(filepath), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _cache_is_fresh(table_dir: str, signature: dict) -> bool:
+    manifest = os.path.join(table_dir, '_source.json')
+    if not os.path.exists(manifest):
+        return False
+    with open(manifest) as f:
+        return json.load(f) == signature
+
+
+def _write_chartevents_buckets(source: str, table_dir: str, buckets: int, chunksize: int):
+    writers = {}
+    file_row = 0
+    try:
+        for chunk in pd.read_csv(source, usecols=list(CHARTEVENTS_DTYPES), dtype=CHARTEVENTS_DTYPES, chunksize=chunksize):
+            chunk['CHARTTIME'] = pd.to_datetime(chunk['CHARTTIME'], format=MIMIC_DATETIME_FORMAT)
+            chunk['FILE_ROW'] = np.arange(file_row, file_row + len(chunk))
+            file_row += len(chunk)
+            for bucket, rows in chunk.groupby(chunk['SUBJECT_ID'].values % buckets, sort=False):
+                if bucket not in writers:
+                    bucket_dir = os.path.join(table_dir, f'SUBJECT_BUCKET={bucket}')
+                    os.makedirs(bucket_dir)
+                    writers[bucket] = pq.ParquetWriter(os.path.join(bucket_dir, 'part-0.parquet'), CHARTEVENTS_CACHE_SCHEMA)
+                writers[bucket].write_table(
+                    pa.Table.from_pandas(rows, schema=CHARTEVENTS_CACHE_SCHEMA, preserve_index=False)
+                )
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def _csv_dtypes(dtypes: dict) -> dict:
+    # read_csv cannot parse dates through dtype, they are converted by apply_table_dtypes
+    return {column: dtype for column, dtype in (dtypes or {}).items() if not pd.api.types.is_datetime64_any_dtype(dtype)}
+
+
+def apply_table_dtypes(data: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    """
+    Converts the columns of a raw table to their declared dtypes, so a table gives
+    the same columns whether it is read from the CSV or from the Parquet cache.
+    Parsed datetime columns declared as object are written back as MIMIC datetime
+    strings, as read_csv leaves them.
+    """
+    for column, dtype in (dtypes or {}).items():
+        if column not in data.columns:
+            continue
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            data[column] = pd.to_datetime(data[column], format=MIMIC_DATETIME_FORMAT)
+        elif pd.api.types.is_datetime64_any_dtype(data[column]) and pd.api.types.is_object_dtype(dtype):
+            data[column] = data[column].dt.strftime(MIMIC_DATETIME_FORMAT)
+        else:
+            data[column] = data[column].astype(dtype)
+    return data
+
+
+def read_raw_table(filepath: str, columns: list = None, dtypes: dict = None) -> pd.DataFrame:
+    """
+    Reads one raw MIMIC-III table from its CSV, loading only the columns asked for
+    with their declared dtypes (see apply_table_dtypes).
+    """
+    data = pd.read_csv(filepath, usecols=columns, dtype=_csv_dtypes(dtypes))
+    if columns is not None:
+        # usecols keeps the file's column order, read_parquet the order asked for
+        data = data[columns]
+    return apply_table_dtypes(data, dtypes)
+
+
+def cache_raw_table(source: str, cache_dir: str, table: str, chartevents_buckets: int = 64, chunksize: int = 1000000, dtypes: dict = None) -> dict:
+    """
+    Converts one raw MIMIC-III table to typed Parquet, once. Datetime columns are
+    parsed and CHARTEVENTS is partitioned into SUBJECT_ID buckets
+    (``SUBJECT_ID % chartevents_buckets``) so readers can skip the buckets they do
+    not need.
+
+    The table is only converted again when the size or modification time of its
+    source file changes.
+
+    inputs:
+        - path to the raw .csv.gz file
+        - directory the cache is written to
+        - name of the table (a key of RAW_TABLE_FILES)
+        - number of SUBJECT_ID buckets CHARTEVENTS is partitioned into
+        - number of CHARTEVENTS rows converted at a time
+        - declared dtypes of the table's columns, so e.g. codes declared as object
+          are not cached as numbers (CHARTEVENTS always uses CHARTEVENTS_DTYPES)
+
+    returns:
+        - the source signature the cached table was built from
+    """
+    table_dir = os.path.join(cache_dir, table)
+    signature = _source_signature(source)
+    if table == 'chartevents':
+        signature['buckets'] = chartevents_buckets
+    elif dtypes:
+        signature['dtypes'] = dtypes
+    if _cache_is_fresh(table_dir, signature):
+        return signature
+
+    print(f"Caching {os.path.basename(source)} as Parquet")
+    with replace_directory(table_dir) as staging_dir:
+        if table == 'chartevents':
+            _write_chartevents_buckets(source, staging_dir, chartevents_buckets, chunksize)
+        else:
+            data = pd.read_csv(source, dtype=_csv_dtypes(dtypes))
+            for column in DATETIME_COLUMNS.get(table, []):
+                if column in data.columns:
+                    data[column] = pd.to_datetime(data[column], format=MIMIC_DATETIME_FORMAT)
+            data.to_parquet(os.path.join(staging_dir, 'part-0.parquet'), index=False)
+        with open(os.path.join(staging_dir, '_source.json'), 'w') as f:
+            json.dump(signature, f)
+    return signature
+
+
+def read_cached_table(cache_dir: str, table: str, columns: list = None, dtypes: dict = None) -> pd.DataFrame:
+    """
+    Reads one table from the Parquet cache, loading only the columns asked for
+    with their declared dtypes (see apply_table_dtypes).
+    """
+    return apply_table_dtypes(pd.read_parquet(os.path.join(cache_dir, table), columns=columns), dtypes)
+
+
+def chartevents_bucket_paths(cache_dir: str, subject_buckets: list = None) -> list:
+    """
+    Lists the cached CHARTEVENTS bucket files, optionally only those for the given
+    SUBJECT_ID buckets.
+    """
+    table_dir = os.path.join(cache_dir, 'chartevents')
+    paths = []
+    for name in sorted(os.listdir(table_dir)):
+        if not name.startswith('SUBJECT_BUCKET='):
+            continue
+        if subject_buckets is not None and int(name.split('=')[1]) not in subject_buckets:
+            continue
+        paths.append(os.path.join(table_dir, name, 'part-0.parquet'))
+    if not paths:
+        raise ValueError(f"No cached CHARTEVENTS buckets in {table_dir} match {subject_buckets}")
+    return paths
+
+
+def read_cached_chartevents(
+    cache_dir: str,
+    icustay_ids: pd.Series = None,
+    events_per_stay: int = None,
+    nrows: int = None,
+    subject_buckets: list = None,
+) -> pd.DataFrame:
+    """
+    Reads CHARTEVENTS from the Parquet cache one SUBJECT_ID bucket at a time.
+
+    Passing icustay_ids and events_per_stay gives the same events as
+    stream_chartevents, passing nrows the same events as read_chartevents_head
+    (the row limit is pushed down to the Parquet reader). Events are returned in
+    their original file order.
+
+    inputs:
+        - directory holding the cache
+        - ICU stays to keep events for, all events are kept when None
+        - maximum number of events kept per subject and ICU stay, no limit when None
+        - only read events from the first nrows rows of the original file
+        - only read these SUBJECT_ID buckets, all buckets are read when None
+
+    returns:
+        - chartevents
+    """
+    columns = list(CHARTEVENTS_DTYPES) + ['FILE_ROW']
+    filters = [('FILE_ROW', '<', nrows)] if nrows is not None else None
+    if icustay_ids is not None:
+        icustay_ids = pd.unique(np.asarray(icustay_ids, dtype='float64'))
+
+    bucket_events = []
+    for path in chartevents_bucket_paths(cache_dir, subject_buckets):
+        events = pd.read_parquet(path, columns=columns, filters=filters)
+        if icustay_ids is not None:
+            events = events[events['ICUSTAY_ID'].isin(icustay_ids)]
+        if events_per_stay is not None:
+            events = events.groupby(['SUBJECT_ID', 'ICUSTAY_ID'], sort=False).head(events_per_stay)
+        bucket_events.append(events)
+
+    chartevents = pd.concat(bucket_events, ignore_index=True)
+    chartevents = chartevents.sort_values('FILE_ROW').drop(columns='FILE_ROW').reset_index(drop=True)
+    if icustay_ids is not None:
+        chartevents['ICUSTAY_ID'] = chartevents['ICUSTAY_ID'].astype('int64')
+    return chartevents
@@ -0,0 +1,89 @@
+import json
+import os
+
+import pandas as pd
+import numpy as np
+
+from data_preparation.io_utils import replace_directory
+from data_preparation.subject_random import subject_fingerprints
+
+
+def _table_hash(table: pd.DataFrame) -> str:
+    return str(int(pd.util.hash_pandas_object(table, index=False).values.sum(dtype=np.uint64)))
+
+
+def dataset_signature(dataset_spec: dict, keyed_joins: bool, seed: int, items: pd.DataFrame) -> dict:
+    """
+    Describes the settings a dataset is built with. Every subject is rebuilt when
+    any of these change.
+    """
+    signature = {'dataset_spec': dataset_spec, 'keyed_joins': keyed_joins, 'seed': seed, 'items': _table_hash(items)}
+    # Round trip through JSON so it compares equal to a saved signature
+    return json.loads(json.dumps(signature))
+
+
+def dataset_fingerprints(tables: list, events: pd.DataFrame) -> pd.Series:
+    """
+    Fingerprints every subject from their raw rows and the chart events selected
+    for one dataset, so a subject's fingerprint changes when, and only when, the
+    rows their part of the dataset is built from change.
+
+    inputs:
+        - admissions, (preprocessed) patients and icustays
+        - chart events selected for the dataset, with _event_rank
+
+    returns:
+        - uint64 fingerprints indexed by SUBJECT_ID
+    """
+    subject_ids, row_hashes = [], []
+    for table_index, table in enumerate(tables + [events]):
+        # Salting by table stops identical rows in two tables cancelling out
+        hashes = pd.util.hash_pandas_object(table, index=False).values
+        subject_ids.append(table['SUBJECT_ID'].values)
+        salt = np.uint64(((table_index + 1) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF)
+        row_hashes.append(hashes ^ salt)
+    return subject_fingerprints(np.concatenate(subject_ids), np.concatenate(row_hashes))
+
+
+def load_dataset_state(state_dir: str, name: str, signature: dict):
+    """
+    Reads a dataset and its subject fingerprints as saved by the last build, if
+    it was built with the same signature.
+
+    returns:
+        - the dataset and its fingerprints, or None when there is no usable state
+    """
+    dataset_dir = os.path.join(state_dir, name)
+    manifest = os.path.join(dataset_dir, '_signature.json')
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest) as f:
+        if json.load(f) != signature:
+            return None
+    dataset = pd.read_parquet(os.path.join(dataset_dir, 'dataset.parquet'))
+    fingerprints = pd.read_parquet(os.path.join(dataset_dir, 'fingerprints.parquet'))
+    return dataset, fingerprints.set_index('SUBJECT_ID')['FINGERPRINT']
+
+
+def save_dataset_state(state_dir: str, name: str, signature: dict, dataset: pd.DataFrame, fingerprints: pd.Series):
+    """
+    Saves a built dataset and its subject fingerprints for the next incremental build.
+    """
+    dataset_dir = os.path.join(state_dir, name)
+    with replace_directory(dataset_dir) as staging_dir:
+        dataset.to_parquet(os.path.join(staging_dir, 'dataset.parquet'), index=False)
+        fingerprints.rename_axis('SUBJECT_ID').rename('FINGERPRINT').reset_index().to_parquet(
+            os.path.join(staging_dir, 'fingerprints.parquet'), index=False
+        )
+        with open(os.path.join(staging_dir, '_signature.json'), 'w') as f:
+            json.dump(signature, f)
+
+
+def changed_subjects(fingerprints: pd.Series, previous_fingerprints: pd.Series) -> pd.Index:
+    """
+    Lists subjects that are new or whose fingerprint differs from the last build.
+    """
+    known = fingerprints.index.isin(previous_fingerprints.index)
+    unchanged = np.zeros(len(fingerprints), dtype=bool)
+    unchanged[known] = previous_fingerprints.loc[fingerprints.index[known]].values == fingerprints.values[known]
+    return fingerprints.index[~unchanged]
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+# Independent random streams used by the preprocessing
+DOB_OFFSET_STREAM = 0
+ADMIT_DAYS_STREAM = 1
+DISCH_DAYS_STREAM = 2
+CHART_SECONDS_STREAM = 3
+
+
+def _mix(state: np.ndarray) -> np.ndarray:
+    # splitmix64 step, uint64 arithmetic wraps around on overflow
+    state = state + np.uint64(0x9E3779B97F4A7C15)
+    state = (state ^ (state >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    state = (state ^ (state >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return state ^ (state >> np.uint64(31))
+
+
+def keyed_uniform(seed: int, stream: int, *keys) -> np.ndarray:
+    """
+    Draws one uniform number in [0, 1) per row, as a hash of the seed, the stream
+    and the row's keys (e.g. SUBJECT_ID). A row gets the same number whichever
+    other rows are drawn alongside it, so subjects can be processed in any shard
+    or order and still give the same result.
+
+    inputs:
+        - base seed
+        - stream number, so different quantities drawn for the same row are independent
+        - one or more integer arrays identifying each row
+
+    returns:
+        - array of uniform numbers
+    """
+    state = _mix(np.full(len(keys[0]), seed, dtype=np.uint64) ^ np.uint64(stream))
+    for key in keys:
+        state = _mix(state ^ np.asarray(key).astype(np.int64).astype(np.uint64))
+    return (state >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+
+def keyed_integers(low, high, seed: int, stream: int, *keys) -> np.ndarray:
+    """
+    Draws one integer in [low, high) per row from keyed_uniform, the keyed
+    equivalent of ``numpy.random.Generator.integers(low, high)``.
+    """
+    low = np.asarray(low, dtype=np.int64)
+    high = np.asarray(high, dtype=np.int64)
+    uniform = keyed_uniform(seed, stream, *keys)
+    return low + np.floor(uniform * (high - low)).astype(np.int64)
+
+
+def subject_shards(subject_ids, shards: int) -> np.ndarray:
+    """
+    Assigns each row to one of shards shards by a hash of its SUBJECT_ID, so the
+    rows of a subject always go to the same shard and consecutive or evenly
+    spaced IDs are spread across all of them.
+    """
+    hashed = _mix(np.asarray(subject_ids).astype(np.int64).astype(np.uint64))
+    return (hashed % np.uint64(shards)).astype(np.int64)
+
+
+def subject_fingerprints(subject_ids, row_hashes) -> pd.Series:
+    """
+    Combines per-row hashes into one fingerprint per subject. Each row hash is
+    mixed with the row's position within its subject, so reordering a subject's
+    rows changes its fingerprint, but rows of other subjects never do.
+
+    inputs:
+        - SUBJECT_ID of each row
+        - uint64 hash of each row, e.g. from ``pd.util.hash_pandas_object``
+
+    returns:
+        - uint64 fingerprints indexed by SUBJECT_ID
+    """
+    subject_ids = pd.Series(np.asarray(subject_ids))
+    position = subject_ids.groupby(subject_ids, sort=False).cumcount().values.astype(np.uint64)
+    mixed = _mix(np.asarray(row_hashes, dtype=np.uint64) ^ _mix(position))
+
+    subject_codes, subjects = pd.factorize(subject_ids)
+    fingerprints = np.zeros(len(subjects), dtype=np.uint64)
+    np.add.at(fingerprints, subject_codes, mixed)
+    return pd.Series(fingerprints, index=subjects)
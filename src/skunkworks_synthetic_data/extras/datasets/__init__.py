@@ -0,0 +1,6 @@
+"""Project-specific Kedro datasets."""
+from .encoded_dataset import EncodedTableDataSet
+from .mimic_dataset import ChartEventsDataSet, MIMICTableDataSet
+from .model_dataset import SynthVAEModelDataSet
+
+__all__ = ["MIMICTableDataSet", "ChartEventsDataSet", "EncodedTableDataSet", "SynthVAEModelDataSet"]
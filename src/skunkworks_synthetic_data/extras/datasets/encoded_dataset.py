@@ -0,0 +1,39 @@
+"""``AbstractDataSet`` implementation for tables encoded for SynthVAE."""
+from pathlib import Path
+from typing import Any, Dict
+
+from kedro.io import AbstractDataSet
+
+from synthetic_data_generation.encoded_table import load_encoded_table, save_encoded_table
+
+
+class EncodedTableDataSet(AbstractDataSet):
+    """Dataset for a table encoded for SynthVAE: the fitted ``TabularEncoder`` and
+    the float32 training matrix, saved as ``.npy`` with the encoder as JSON
+    metadata. Saves take a table from ``table_to_encode`` and encode it, unless a
+    table with the same key is already saved (see save_encoded_table). Loads
+    return a dictionary with ``key``, ``encoder`` and a memory-mapped ``matrix``.
+
+    Example catalog entry:
+    ::
+
+        table_one_11040_encoded:
+          type: skunkworks_synthetic_data.extras.datasets.EncodedTableDataSet
+          filepath: data/05_model_input/encoded/table_one_11040
+    """
+
+    def __init__(self, filepath: str):
+        self._filepath = filepath
+
+    def _load(self) -> Dict[str, Any]:
+        return load_encoded_table(self._filepath)
+
+    def _save(self, data: Dict[str, Any]) -> None:
+        Path(self._filepath).mkdir(parents=True, exist_ok=True)
+        save_encoded_table(self._filepath, data)
+
+    def _exists(self) -> bool:
+        return (Path(self._filepath) / "_current.json").exists()
+
+    def _describe(self) -> Dict[str, Any]:
+        return dict(filepath=self._filepath)
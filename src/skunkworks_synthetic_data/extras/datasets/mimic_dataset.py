@@ -0,0 +1,156 @@
+"""``AbstractDataSet`` implementations for the raw MIMIC-III tables."""
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pandas as pd
+from kedro.io import AbstractDataSet, DataSetError
+
+from data_preparation.mimic_loading import (
+    CHARTEVENTS_DTYPES,
+    cache_raw_table,
+    read_cached_chartevents,
+    read_cached_table,
+    read_chartevents_head,
+    read_raw_table,
+    stream_chartevents,
+)
+
+
+class MIMICTableDataSet(AbstractDataSet):
+    """Read-only dataset for one raw MIMIC-III table, loading only the declared
+    columns with the declared dtypes. When ``cache_dir`` is set the table is read
+    from a typed Parquet copy that is built on first load and rebuilt when the raw
+    file or the dtypes change; the loaded columns are the same either way.
+
+    Example catalog entry:
+    ::
+
+        Admissions:
+          type: skunkworks_synthetic_data.extras.datasets.MIMICTableDataSet
+          filepath: data/01_raw/admissions.csv.gz
+          table: admissions
+          columns: [ROW_ID, SUBJECT_ID, ETHNICITY]
+          dtypes:
+            ROW_ID: int64
+          cache_dir: data/02_intermediate/mimic_parquet
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        table: str,
+        columns: List[str] = None,
+        dtypes: Dict[str, str] = None,
+        cache_dir: str = None,
+    ):
+        self._filepath = filepath
+        self._table = table
+        self._columns = columns
+        self._dtypes = dtypes
+        self._cache_dir = cache_dir
+
+    def _load(self) -> pd.DataFrame:
+        if self._cache_dir:
+            cache_raw_table(self._filepath, self._cache_dir, self._table, dtypes=self._dtypes)
+            return read_cached_table(self._cache_dir, self._table, self._columns, self._dtypes)
+        return read_raw_table(self._filepath, self._columns, self._dtypes)
+
+    def _save(self, data: pd.DataFrame) -> None:
+        raise DataSetError(f"{self.__class__.__name__} is read-only")
+
+    def _exists(self) -> bool:
+        return Path(self._filepath).exists()
+
+    def _describe(self) -> Dict[str, Any]:
+        return dict(
+            filepath=self._filepath,
+            table=self._table,
+            columns=self._columns,
+            cache_dir=self._cache_dir,
+        )
+
+
+class ChartEventsDataSet(MIMICTableDataSet):
+    """Read-only dataset for CHARTEVENTS, which is too large to load whole.
+
+    ``mode: stream`` reads the whole file and keeps the first ``events_per_stay``
+    events of each ICU stay listed in ``icustays_filepath``. ``mode: head`` keeps
+    only the first ``nrows`` rows of the file. With ``cache_dir`` set the events
+    are read from the Parquet cache one SUBJECT_ID bucket at a time, and
+    ``subject_buckets`` limits the read to those buckets (``SUBJECT_ID %
+    chartevents_buckets``), e.g. to build the input files for a subset of subjects.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        icustays_filepath: str,
+        mode: str = "stream",
+        events_per_stay: int = 100,
+        nrows: int = None,
+        chunksize: int = 1000000,
+        chartevents_buckets: int = 64,
+        cache_dir: str = None,
+        subject_buckets: List[int] = None,
+    ):
+        if mode not in ("stream", "head"):
+            raise DataSetError(
+                f"Unknown chartevents loading mode: {mode}, expected 'stream' or 'head'"
+            )
+        if subject_buckets is not None and not cache_dir:
+            raise DataSetError("subject_buckets needs the Parquet cache, set cache_dir")
+        super().__init__(
+            filepath,
+            table="chartevents",
+            columns=list(CHARTEVENTS_DTYPES),
+            dtypes=CHARTEVENTS_DTYPES,
+            cache_dir=cache_dir,
+        )
+        self._icustays_filepath = icustays_filepath
+        self._mode = mode
+        self._events_per_stay = events_per_stay
+        self._nrows = nrows
+        self._chunksize = chunksize
+        self._chartevents_buckets = chartevents_buckets
+        self._subject_buckets = subject_buckets
+
+    def _load(self) -> pd.DataFrame:
+        if self._mode == "stream":
+            icustay_ids = pd.read_csv(self._icustays_filepath, usecols=["ICUSTAY_ID"])
+            icustay_ids = icustay_ids["ICUSTAY_ID"]
+        if self._cache_dir:
+            cache_raw_table(
+                self._filepath,
+                self._cache_dir,
+                self._table,
+                self._chartevents_buckets,
+                self._chunksize,
+            )
+            if self._mode == "stream":
+                return read_cached_chartevents(
+                    self._cache_dir,
+                    icustay_ids=icustay_ids,
+                    events_per_stay=self._events_per_stay,
+                    subject_buckets=self._subject_buckets,
+                )
+            return read_cached_chartevents(
+                self._cache_dir, nrows=self._nrows, subject_buckets=self._subject_buckets
+            )
+
+        if self._mode == "stream":
+            return stream_chartevents(
+                self._filepath,
+                icustay_ids=icustay_ids,
+                events_per_stay=self._events_per_stay,
+                chunksize=self._chunksize,
+            )
+        return read_chartevents_head(self._filepath, self._nrows)
+
+    def _describe(self) -> Dict[str, Any]:
+        return dict(
+            super()._describe(),
+            mode=self._mode,
+            events_per_stay=self._events_per_stay,
+            nrows=self._nrows,
+            subject_buckets=self._subject_buckets,
+        )
@@ -0,0 +1,38 @@
+"""``AbstractDataSet`` implementation for trained SynthVAE models."""
+from pathlib import Path
+from typing import Any, Dict
+
+from kedro.io import AbstractDataSet
+
+from synthetic_data_generation.synthvae_model import load_synthvae_model, save_synthvae_model
+
+
+class SynthVAEModelDataSet(AbstractDataSet):
+    """Dataset for a model trained by ``train_synthvae``: the VAE state dict,
+    saved as ``model.pt``, and the fitted ``TabularEncoder``, VAE layout and seed,
+    saved as ``metadata.json``. Loads return the model dictionary with the VAE
+    rebuilt from the state dict.
+
+    Example catalog entry:
+    ::
+
+        table_one_11040_model:
+          type: skunkworks_synthetic_data.extras.datasets.SynthVAEModelDataSet
+          filepath: data/06_models/table_one_11040
+    """
+
+    def __init__(self, filepath: str):
+        self._filepath = filepath
+
+    def _load(self) -> Dict[str, Any]:
+        return load_synthvae_model(self._filepath)
+
+    def _save(self, data: Dict[str, Any]) -> None:
+        Path(self._filepath).parent.mkdir(parents=True, exist_ok=True)
+        save_synthvae_model(self._filepath, data)
+
+    def _exists(self) -> bool:
+        return (Path(self._filepath) / "metadata.json").exists()
+
+    def _describe(self) -> Dict[str, Any]:
+        return dict(filepath=self._filepath)
@@ -26,6 +26,20 @@ def register_pipelines() -> Dict[str, Pipeline]:
     small_preproc_pipeline = data_generation.small_preproc_pipeline()
     medium_preproc_pipeline = data_generation.medium_preproc_pipeline()
     large_preproc_pipeline = data_generation.large_preproc_pipeline()
+    all_preproc_pipeline = data_generation.preproc_pipeline(
+        [
+            "table_one_11040",
+            "table_one_imbalanced_81795",
+            "table_one_imbalanced_217010",
+        ]
+    )
+    all_preproc_duckdb_pipeline = data_generation.preproc_duckdb_pipeline(
+        [
+            "table_one_11040",
+            "table_one_imbalanced_81795",
+            "table_one_imbalanced_217010",
+        ]
+    )
 
     small_synthetic_generation_pipeline = (
         data_generation.generate_synthetic_input_pipeline("table_one_11040")
@@ -37,6 +51,48 @@ def register_pipelines() -> Dict[str, Pipeline]:
         data_generation.generate_synthetic_input_pipeline("table_one_imbalanced_217010")
     )
 
+    # Train once, then generate from the saved model as often as needed
+    small_train_pipeline = data_generation.train_synthetic_model_pipeline("table_one_11040")
+    medium_train_pipeline = data_generation.train_synthetic_model_pipeline(
+        "table_one_imbalanced_81795"
+    )
+    large_train_pipeline = data_generation.train_synthetic_model_pipeline(
+        "table_one_imbalanced_217010"
+    )
+    small_generate_pipeline = data_generation.generate_from_model_pipeline("table_one_11040")
+    medium_generate_pipeline = data_generation.generate_from_model_pipeline(
+        "table_one_imbalanced_81795"
+    )
+    large_generate_pipeline = data_generation.generate_from_model_pipeline(
+        "table_one_imbalanced_217010"
+    )
+
+    small_stream_pipeline = data_generation.stream_from_model_pipeline("table_one_11040")
+    medium_stream_pipeline = data_generation.stream_from_model_pipeline(
+        "table_one_imbalanced_81795"
+    )
+    large_stream_pipeline = data_generation.stream_from_model_pipeline(
+        "table_one_imbalanced_217010"
+    )
+    small_parallel_generate_pipeline = data_generation.parallel_generate_from_model_pipeline(
+        "table_one_11040"
+    )
+    medium_parallel_generate_pipeline = data_generation.parallel_generate_from_model_pipeline(
+        "table_one_imbalanced_81795"
+    )
+    large_parallel_generate_pipeline = data_generation.parallel_generate_from_model_pipeline(
+        "table_one_imbalanced_217010"
+    )
+    small_export_generator_pipeline = data_generation.export_generator_pipeline(
+        "table_one_11040"
+    )
+    medium_export_generator_pipeline = data_generation.export_generator_pipeline(
+        "table_one_imbalanced_81795"
+    )
+    large_export_generator_pipeline = data_generation.export_generator_pipeline(
+        "table_one_imbalanced_217010"
+    )
+
     # Evalulation pipelines
     small_data_evaluation_pipeline = data_evaluation.eval_pipeline(
         real_data="table_one_11040", synthetic_data="synthetic_data_input"
@@ -98,9 +154,28 @@ def register_pipelines() -> Dict[str, Pipeline]:
         "small_preproc_pipeline": small_preproc_pipeline,
         "medium_preproc_pipeline": medium_preproc_pipeline,
         "large_preproc_pipeline": large_preproc_pipeline,
+        "all_preproc_pipeline": Pipeline([load_data_pipeline, all_preproc_pipeline]),
+        "all_preproc_duckdb_pipeline": Pipeline(
+            [load_data_pipeline, all_preproc_duckdb_pipeline]
+        ),
         "small_synthetic_generation_pipeline": small_synthetic_generation_pipeline,
         "medium_synthetic_generation_pipeline": small_synthetic_generation_pipeline,
         "large_synthetic_generation_pipeline": small_synthetic_generation_pipeline,
+        "small_train_pipeline": small_train_pipeline,
+        "medium_train_pipeline": medium_train_pipeline,
+        "large_train_pipeline": large_train_pipeline,
+        "small_generate_pipeline": small_generate_pipeline,
+        "medium_generate_pipeline": medium_generate_pipeline,
+        "large_generate_pipeline": large_generate_pipeline,
+        "small_stream_pipeline": small_stream_pipeline,
+        "medium_stream_pipeline": medium_stream_pipeline,
+        "large_stream_pipeline": large_stream_pipeline,
+        "small_parallel_generate_pipeline": small_parallel_generate_pipeline,
+        "medium_parallel_generate_pipeline": medium_parallel_generate_pipeline,
+        "large_parallel_generate_pipeline": large_parallel_generate_pipeline,
+        "small_export_generator_pipeline": small_export_generator_pipeline,
+        "medium_export_generator_pipeline": medium_export_generator_pipeline,
+        "large_export_generator_pipeline": large_export_generator_pipeline,
         "support_generate_pipeline": support_generate_pipeline,
         "support_demo_pipeline": support_demo_pipeline,
         "small_end_to_end": small_end_to_end,
@@ -1,10 +1,12 @@
+import copy
+import math
+
 import torch
 import torch.nn as nn
 
 from synthetic_data_generation.SynthVAE.opacus import PrivacyEngine
 
 # from torch.distributions.bernoulli import Bernoulli
-from torch.distributions.normal import Normal
 
 from tqdm import tqdm
 
@@ -105,8 +107,11 @@ class Noiser(nn.Module):
 class VAE(nn.Module):
     """Combines encoder and decoder into full VAE model"""
 
-    def __init__(self, encoder, decoder, lr=1e-3):
+    def __init__(self, encoder, decoder, lr=1e-3, bf16=False):
         super().__init__()
+        # With bf16, the encoder and decoder run under bfloat16 autocast while the
+        # loss, its accumulation and the Noiser scale stay in float32
+        self.bf16 = bf16
         self.encoder = encoder.to(encoder.device)
         self.decoder = decoder.to(decoder.device)
         self.num_categories = self.decoder.num_categories
@@ -115,76 +120,167 @@ class VAE(nn.Module):
         self.optimizer = torch.optim.Adam(self.parameters(), lr=lr)
         self.lr = lr
 
+        # Gathers every categorical block into a row of a (blocks, widest block)
+        # tensor so all blocks are handled in one pass; padding is masked out
+        widths = torch.as_tensor([int(n) for n in self.num_categories], dtype=torch.long)
+        offsets = torch.cumsum(widths, 0) - widths
+        positions = torch.arange(int(widths.max()) if len(widths) else 0)
+        padding = positions[None, :] >= widths[:, None]
+        index = (offsets[:, None] + positions[None, :]).masked_fill(padding, 0)
+        self.register_buffer(
+            "category_padding", padding.to(decoder.device), persistent=False
+        )
+        self.register_buffer(
+            "category_index", index.to(decoder.device), persistent=False
+        )
+
+    def autocast(self):
+        """bfloat16 autocast context for the encoder and decoder when bf16 is set"""
+        return torch.autocast(
+            device_type=self.decoder.device.type, dtype=torch.bfloat16, enabled=self.bf16
+        )
+
+    def padded_categories(self, X):
+        """Gathers the categorical blocks of X into a (rows, blocks, widest block)
+        tensor, with padding entries set to -inf"""
+        return X[:, self.category_index].masked_fill(self.category_padding, float("-inf"))
+
     def reconstruct(self, X):
         mu_z, logsigma_z = self.encoder(X)
 
         x_recon = self.decoder(mu_z)
         return x_recon
 
-    def generate(self, N):
+    def generate_indices(self, N):
+        """Generates N rows without one-hot encoding them: the category sampled
+        for each categorical block, shape (N, blocks), and the continuous
+        columns, shape (N, num_continuous)"""
         z_samples = torch.randn_like(torch.ones((N, self.encoder.latent_dim)))
-        x_gen = self.decoder(z_samples)
-        x_gen_ = torch.ones_like(x_gen)
-        i = 0
-        for v in range(len(self.num_categories)):
-            x_gen_[
-                :, i : (i + self.num_categories[v])
-            ] = torch.distributions.one_hot_categorical.OneHotCategorical(
-                logits=x_gen[:, i : (i + self.num_categories[v])]
-            ).sample()
-            i = i + self.num_categories[v]
-        x_gen_[:, -self.num_continuous :] = x_gen[
-            :, -self.num_continuous :
-        ] + torch.exp(
-            self.noiser(x_gen[:, -self.num_continuous :])
-        ) * torch.randn_like(
-            x_gen[:, -self.num_continuous :]
-        )
-        return x_gen_
-
-    def loss(self, X):
-        mu_z, logsigma_z = self.encoder(X)
+        with self.autocast():
+            x_gen = self.decoder(z_samples)
+        if self.bf16:
+            x_gen = x_gen.float()
 
-        p = Normal(torch.zeros_like(mu_z), torch.ones_like(mu_z))
-        q = Normal(mu_z, torch.exp(logsigma_z))
+        category_indices = torch.zeros(
+            (N, len(self.num_categories)), dtype=torch.long, device=x_gen.device
+        )
+        if sum(self.num_categories) != 0:
+            # Gumbel-max: the argmax of logits plus Gumbel noise is a sample from
+            # the categorical distribution, so the noise for every block is drawn
+            # in one pass. Each block then only needs an argmax over its own
+            # columns, which avoids padding narrow blocks to the widest one
+            logits = x_gen[:, : int(sum(self.num_categories))]
+            uniform = torch.rand_like(logits).clamp_(min=torch.finfo(logits.dtype).tiny)
+            perturbed = logits - torch.log(-torch.log(uniform))
+            i = 0
+            for v in range(len(self.num_categories)):
+                category_indices[:, v] = perturbed[
+                    :, i : (i + self.num_categories[v])
+                ].argmax(dim=1)
+                i = i + self.num_categories[v]
+
+        continuous = x_gen[:, x_gen.shape[1] - self.num_continuous :]
+        if self.num_continuous != 0:
+            continuous = continuous + torch.exp(
+                self.noiser(continuous)
+            ) * torch.randn_like(continuous)
+        return category_indices, continuous
 
-        encoder_loss = torch.sum(torch.distributions.kl_divergence(q, p))
+    def generate(self, N):
+        category_indices, continuous = self.generate_indices(N)
+        x_gen_ = torch.zeros(
+            (N, int(sum(self.num_categories))), dtype=continuous.dtype, device=continuous.device
+        )
+        if sum(self.num_categories) != 0:
+            # Column of each sampled category in the one-hot layout
+            x_gen_.scatter_(1, category_indices + self.category_index[:, :1].T, 1.0)
+        return torch.cat([x_gen_, continuous], dim=1)
+
+    def loss(self, X, sum_rows=False):
+        """Negative ELBO of X. The KL and Gaussian terms are summed over rows and,
+        as SynthVAE trains, the categorical term is averaged over them; with
+        sum_rows it is summed over rows too, so the loss of a set of rows does not
+        depend on how they are split into batches."""
+        with self.autocast():
+            mu_z, logsigma_z = self.encoder(X)
+        if self.bf16:
+            mu_z, logsigma_z = mu_z.float(), logsigma_z.float()
+
+        # Closed form KL(N(mu_z, exp(logsigma_z)) || N(0, 1))
+        encoder_loss = torch.sum(
+            0.5 * (mu_z ** 2 + torch.exp(2 * logsigma_z)) - logsigma_z - 0.5
+        )
 
         s = torch.randn_like(mu_z)
         z_samples = mu_z + s * torch.exp(logsigma_z)
 
-        x_recon = self.decoder(z_samples)
+        with self.autocast():
+            x_recon = self.decoder(z_samples)
+        if self.bf16:
+            x_recon = x_recon.float()
 
         categoric_loglik = 0
         if sum(self.num_categories) != 0:
-            i = 0
-            for v in range(len(self.num_categories)):
-                categoric_loglik += -torch.nn.functional.cross_entropy(
-                    x_recon[:, i : (i + self.num_categories[v])],
-                    torch.max(X[:, i : (i + self.num_categories[v])], 1)[1],
-                ).sum()
-                i = i + self.decoder.num_categories[v]
+            # Cross entropy of every block at once: log-softmax over each padded
+            # block, then the mean (or sum) over rows of the target's log-probability
+            targets = self.padded_categories(X).argmax(dim=2, keepdim=True)
+            log_probs = torch.log_softmax(self.padded_categories(x_recon), dim=2)
+            target_log_probs = log_probs.gather(2, targets)
+            if sum_rows:
+                categoric_loglik = target_log_probs.sum()
+            else:
+                categoric_loglik = target_log_probs.mean(dim=0).sum()
 
         gauss_loglik = 0
         if self.decoder.num_continuous != 0:
-            gauss_loglik = (
-                Normal(
-                    loc=x_recon[:, -self.num_continuous :],
-                    scale=torch.exp(
-                        self.noiser(x_recon[:, -self.num_continuous :])
-                    ),
-                )
-                .log_prob(X[:, -self.num_continuous :])
-                .sum()
+            mu_x = x_recon[:, -self.num_continuous :]
+            logsigma_x = self.noiser(mu_x)
+            # Closed form Normal(mu_x, exp(logsigma_x)) log-density
+            gauss_loglik = torch.sum(
+                -0.5 * ((X[:, -self.num_continuous :] - mu_x) / torch.exp(logsigma_x)) ** 2
+                - logsigma_x
+                - 0.5 * math.log(2 * math.pi)
             )
 
         reconstruct_loss = -(categoric_loglik + gauss_loglik)
 
         return encoder_loss + reconstruct_loss
 
-    def train(self, x_dataloader, n_epochs, logging_freq=1):
-        # mean_norm = 0
-        # counter = 0
+    def validation_loss(self, x_dataloader):
+        """Loss (negative ELBO) per row over a dataloader, without updating the model"""
+        total_loss = 0.0
+        rows = 0
+        with torch.no_grad():
+            for (Y_subset,) in x_dataloader:
+                total_loss += self.loss(Y_subset.to(self.encoder.device), sum_rows=True).item()
+                rows += Y_subset.shape[0]
+        return total_loss / rows
+
+    def train(
+        self,
+        x_dataloader,
+        n_epochs,
+        logging_freq=1,
+        validation_dataloader=None,
+        patience=None,
+        min_delta=0.0,
+        lr_scheduler=None,
+    ):
+        """Trains for up to n_epochs.
+
+        With a validation_dataloader, the validation loss per row is computed
+        after every epoch and the weights of the epoch with the lowest one are
+        restored at the end. With patience as well, training stops once the
+        validation loss has not improved by more than min_delta for patience
+        epochs. lr_scheduler is stepped after every epoch, with the validation (or
+        else training) loss when it is a ReduceLROnPlateau scheduler.
+
+        The losses of each epoch are kept in self.history.
+        """
+        self.history = []
+        best_loss = float("inf")
+        best_state = None
+        epochs_without_improvement = 0
         for epoch in range(n_epochs):
             train_loss = 0.0
 
@@ -205,10 +301,38 @@ class VAE(nn.Module):
                 # l2_norm = l2_norm ** 0.5  # / Y_subset.shape[0]
                 # mean_norm = (mean_norm * (counter - 1) + l2_norm) / counter
 
+            validation_loss = None
+            if validation_dataloader is not None:
+                validation_loss = self.validation_loss(validation_dataloader)
+            self.history.append({"epoch": epoch, "train_loss": train_loss, "validation_loss": validation_loss})
+
+            if lr_scheduler is not None:
+                if isinstance(lr_scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+                    lr_scheduler.step(train_loss if validation_loss is None else validation_loss)
+                else:
+                    lr_scheduler.step()
+
             if epoch % logging_freq == 0:
-                print(f"\tEpoch: {epoch:2}. Total loss: {train_loss:11.2f}")
-                # print(f"\tMean norm: {mean_norm}")
-        # self.mean_norm = mean_norm
+                validation_log = ""
+                if validation_loss is not None:
+                    validation_log = f". Validation loss per row: {validation_loss:9.4f}"
+                print(f"\tEpoch: {epoch:2}. Total loss: {train_loss:11.2f}{validation_log}")
+
+            if validation_loss is None:
+                continue
+            if validation_loss < best_loss - min_delta:
+                best_loss = validation_loss
+                best_state = copy.deepcopy(self.state_dict())
+                epochs_without_improvement = 0
+            else:
+                epochs_without_improvement += 1
+                if patience is not None and epochs_without_improvement >= patience:
+                    print(f"\tStopping early: no improvement in the last {patience} epochs")
+                    break
+
+        if best_state is not None:
+            self.load_state_dict(best_state)
+            print(f"\tKept the weights with validation loss per row {best_loss:.4f}")
 
     def diff_priv_train(
         self,
@@ -220,7 +344,31 @@ class VAE(nn.Module):
         target_delta=1e-5,
         logging_freq=1,
         sample_rate=0.1,
+        validation_dataloader=None,
+        patience=None,
+        min_delta=0.0,
+        lr_scheduler=None,
     ):
+        """Trains for n_epochs with DP-SGD (see train).
+
+        Early stopping, keeping the best epoch's weights and ReduceLROnPlateau
+        schedules all choose the model from losses on the private rows, which
+        get_privacy_spent does not account for, so they are rejected here.
+        """
+        if validation_dataloader is not None or patience is not None:
+            raise ValueError(
+                "Validation and early stopping select the model on private rows outside "
+                "the privacy accounting, and are not supported with differential privacy"
+            )
+        if isinstance(lr_scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+            raise ValueError(
+                "ReduceLROnPlateau steps on losses outside the privacy accounting, and is "
+                "not supported with differential privacy"
+            )
+        if self.bf16:
+            # Per-sample gradients are computed from the captured bfloat16
+            # activations, which the float32 backprops cannot be combined with
+            raise ValueError("bf16 training is not supported with differential privacy")
         if noise_scale is not None:
             self.privacy_engine = PrivacyEngine(
                 self,
@@ -243,21 +391,15 @@ class VAE(nn.Module):
             )
         self.privacy_engine.attach(self.optimizer)
 
-        for epoch in range(n_epochs):
-            train_loss = 0.0
-            # print(self.get_privacy_spent(target_delta))
-
-            for batch_idx, (Y_subset,) in enumerate(tqdm(x_dataloader)):
-                self.optimizer.zero_grad()
-                loss = self.loss(Y_subset.to(self.encoder.device))
-                loss.backward()
-                self.optimizer.step()
-                train_loss += loss.item()
-                # print(self.get_privacy_spent(target_delta))
-                # print(loss.item())
-
-            if epoch % logging_freq == 0:
-                print(f"\tEpoch: {epoch:2}. Total loss: {train_loss:11.2f}")
+        self.train(
+            x_dataloader,
+            n_epochs,
+            logging_freq=logging_freq,
+            validation_dataloader=validation_dataloader,
+            patience=patience,
+            min_delta=min_delta,
+            lr_scheduler=lr_scheduler,
+        )
 
     def get_privacy_spent(self, delta):
         if hasattr(self, "privacy_engine"):
@@ -0,0 +1,114 @@
+import torch
+
+
+class TensorBatchLoader:
+    """Drop-in replacement for a DataLoader over a TensorDataset, for VAE.train
+    and VAE.diff_priv_train. Each batch is gathered from the pre-built tensor with
+    a single index_select, with no per-row indexing or collation, and yielded as a
+    one-element tuple as a TensorDataset batch would be.
+    """
+
+    def __init__(self, data, batch_sampler, rows=None):
+        """
+        Args:
+            data (Tensor): the full training matrix, one row per sample.
+            batch_sampler (Sampler): yields the row indices of each batch, as
+                lists or index tensors.
+            rows (Tensor): rows of data the sampler's indices refer to (e.g. a
+                training or validation split), all of them when None.
+        """
+        self.data = data
+        self.batch_sampler = batch_sampler
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        for indices in self.batch_sampler:
+            indices = torch.as_tensor(indices, dtype=torch.long)
+            if self.rows is not None:
+                indices = self.rows[indices]
+            yield (self.data.index_select(0, indices),)
+
+
+class PoissonBatchSampler:
+    """Samples batches as UniformWithReplacementSampler does (each sample is in a
+    batch independently with probability ``sample_rate``, as the Sampled Gaussian
+    Mechanism assumes), at O(batch) rather than O(num_samples) cost per batch: the
+    batch size is drawn from Binomial(num_samples, sample_rate) and that many
+    distinct indices are then drawn uniformly.
+    """
+
+    def __init__(self, num_samples, sample_rate, generator=None):
+        """
+        Args:
+            num_samples (int): number of samples to draw from.
+            sample_rate (float): probability of each sample being in a batch.
+            generator (Generator): generator used in sampling, torch's global
+                generator when None.
+        """
+        if num_samples <= 0:
+            raise ValueError(
+                "num_samples should be a positive integer "
+                "value, but got num_samples={}".format(num_samples)
+            )
+        self.num_samples = num_samples
+        self.sample_rate = sample_rate
+        self.generator = generator
+
+    def __len__(self):
+        return int(1 / self.sample_rate)
+
+    def _distinct_indices(self, batch_size):
+        indices = torch.unique(
+            torch.randint(self.num_samples, (batch_size,), generator=self.generator)
+        )
+        # Redraw collisions, which are rare while batches are small next to num_samples
+        while indices.numel() < batch_size:
+            extra = torch.randint(
+                self.num_samples, (batch_size - indices.numel(),), generator=self.generator
+            )
+            indices = torch.unique(torch.cat([indices, extra]))
+        return indices
+
+    def __iter__(self):
+        counts = torch.full((len(self),), float(self.num_samples))
+        batch_sizes = torch.binomial(
+            counts, torch.full_like(counts, self.sample_rate), generator=self.generator
+        )
+        for batch_size in batch_sizes.long().tolist():
+            if batch_size != 0:
+                # Empty batches are skipped, as in UniformWithReplacementSampler
+                yield self._distinct_indices(batch_size)
+
+
+class ShuffledBatchSampler:
+    """Splits a fresh permutation of the samples into fixed-size batches each
+    epoch, for training without differential privacy. The last batch holds what
+    is left over.
+    """
+
+    def __init__(self, num_samples, batch_size, generator=None):
+        """
+        Args:
+            num_samples (int): number of samples to draw from.
+            batch_size (int): number of samples per batch.
+            generator (Generator): generator used in shuffling, torch's global
+                generator when None.
+        """
+        if num_samples <= 0:
+            raise ValueError(
+                "num_samples should be a positive integer "
+                "value, but got num_samples={}".format(num_samples)
+            )
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.generator = generator
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        permutation = torch.randperm(self.num_samples, generator=self.generator)
+        yield from torch.split(permutation, self.batch_size)
@@ -0,0 +1,93 @@
+"""Benchmarks SynthVAE training and generation in float32 against bfloat16 autocast.
+
+Runs on the encoded MIMIC-III input tables saved by the generation pipelines (see
+save_encoded_table), each mode in a fresh process so peak memory is measured per run.
+From the src directory:
+
+    python -m synthetic_data_generation.benchmark_precision --tables table_one_11040 table_one_imbalanced_81795
+
+The only results so far come from a small generated sample table with the
+MIMIC-III columns, not from the MIMIC-III input tables: on one AVX512-BF16 core,
+training ran at about the same speed in both modes and generation 15-30%
+faster in bfloat16, with the same loss. Run this on the encoded MIMIC-III tables
+before relying on bf16 for them.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import torch
+
+from synthetic_data_generation.encoded_table import load_encoded_table
+from synthetic_data_generation.synthvae_model import build_vae
+from synthetic_data_generation.SynthVAE.data_loading import ShuffledBatchSampler, TensorBatchLoader
+from synthetic_data_generation.SynthVAE.utils import set_seed
+
+
+def run_benchmark(encoded_tables_dir: str, table_name: str, bf16: bool, epochs: int, generate_rows: int, threads: int) -> dict:
+    """
+    Trains a VAE for a fixed number of epochs and generates rows from it, timing both.
+
+    returns:
+        - dictionary of the run's settings, throughputs and peak resident memory
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    set_seed(0)
+    encoded_table = load_encoded_table(os.path.join(encoded_tables_dir, table_name))
+    if encoded_table is None:
+        raise ValueError(f"No encoded table in {os.path.join(encoded_tables_dir, table_name)}, run its generation pipeline first")
+    Y = torch.from_numpy(encoded_table["matrix"])
+    vae = build_vae(encoded_table["encoder"], bf16=bf16)
+    data_loader = TensorBatchLoader(Y, ShuffledBatchSampler(num_samples=Y.shape[0], batch_size=32))
+
+    start = time.perf_counter()
+    vae.train(data_loader, n_epochs=epochs, logging_freq=epochs)
+    train_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        vae.generate_indices(generate_rows)
+    generate_seconds = time.perf_counter() - start
+
+    return {
+        "table": table_name,
+        "precision": "bfloat16" if bf16 else "float32",
+        "training_rows_per_second": Y.shape[0] * epochs / train_seconds,
+        "generated_rows_per_second": generate_rows / generate_seconds,
+        "final_loss": vae.history[-1]["train_loss"] / Y.shape[0],
+        # ru_maxrss is in kilobytes on Linux
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--encoded-tables-dir", default="data/05_model_input/encoded")
+    parser.add_argument("--tables", nargs="+", default=["table_one_11040"])
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--generate-rows", type=int, default=1000000)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, torch's default when 0")
+    parser.add_argument("--output", default=None, help="CSV file to save the results to")
+    args = parser.parse_args()
+
+    results = []
+    for table_name in args.tables:
+        for bf16 in (False, True):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results.append(executor.submit(
+                    run_benchmark, args.encoded_tables_dir, table_name, bf16, args.epochs, args.generate_rows, args.threads
+                ).result())
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
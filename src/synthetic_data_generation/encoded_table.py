@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from data_preparation.io_utils import replace_directory
+from synthetic_data_generation.tabular_encoder import TabularEncoder
+
+# Bump when TabularEncoder changes how a table is encoded, so cached matrices are rebuilt
+ENCODING_VERSION = 1
+
+
+def prepare_training_table(table_one: pd.DataFrame, all_columns: list) -> pd.DataFrame:
+    """
+    Puts a MIMIC-III input table in the form SynthVAE is trained on: SUBJECT_ID
+    as a float, ADMITTIME as seconds since 1970 (earlier admissions are dropped)
+    and age as a positive number of years.
+
+    inputs:
+        - input table built by the preprocessing pipelines
+        - columns to keep
+
+    returns:
+        - the training table
+    """
+    table_one = table_one.copy()
+    table_one['SUBJECT_ID'] = table_one['SUBJECT_ID'].astype(float)
+    table_one['ADMITTIME'] = pd.to_datetime(table_one['ADMITTIME'])
+    table_one = table_one[(table_one['ADMITTIME']>pd.Timestamp("1970-01-01"))]
+    table_one['ADMITTIME'] = (table_one['ADMITTIME'] - pd.Timestamp("1970-01-01")) // pd.Timedelta('1s')
+    table_one['ADMITTIME'] = table_one['ADMITTIME'].astype(float)
+    table_one['age'] = np.abs(table_one['age'])
+    return table_one[all_columns]
+
+
+def encoding_key(table: pd.DataFrame, columns: list, categorical_columns: list) -> str:
+    """
+    Hashes the content of a table (in row order) together with the column
+    settings it is encoded with.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([ENCODING_VERSION, list(columns), sorted(categorical_columns)]).encode())
+    digest.update(pd.util.hash_pandas_object(table[columns], index=False).values.tobytes())
+    digest.update(json.dumps([str(dtype) for dtype in table[columns].dtypes]).encode())
+    return digest.hexdigest()[:16]
+
+
+def save_encoded_table(directory: str, to_encode: dict):
+    """
+    Encodes a table (see table_to_encode) and saves it as ``<key>/matrix.npy`` and
+    ``<key>/encoder.json``, marking it as the current one. The TabularEncoder is
+    fitted and the matrix written chunk_rows rows at a time, straight to a
+    memory-mapped .npy, so the whole matrix is never in memory. Nothing is fitted
+    or written when a table with the same key is already saved; encoded tables
+    for other keys are removed.
+
+    inputs:
+        - directory holding the encoded versions of one table
+        - the table to encode, as returned by table_to_encode
+    """
+    key = to_encode["key"]
+    key_dir = os.path.join(directory, key)
+    if os.path.exists(os.path.join(key_dir, "encoder.json")):
+        print(f"Reusing encoded table {key}")
+    else:
+        with replace_directory(key_dir) as staging_dir:
+            encoder = _write_encoded_matrix(os.path.join(staging_dir, "matrix.npy"), to_encode)
+            with open(os.path.join(staging_dir, "encoder.json"), "w") as f:
+                json.dump(encoder.to_dict(), f)
+
+    with open(os.path.join(directory, "_current.json"), "w") as f:
+        json.dump({"key": key}, f)
+    for name in os.listdir(directory):
+        if name not in (key, "_current.json"):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def _write_encoded_matrix(filepath: str, to_encode: dict) -> TabularEncoder:
+    table = to_encode["table"]
+    chunk_rows = to_encode["chunk_rows"]
+    print(f"Encoding {table.shape[0]} rows ({to_encode['key']})")
+    encoder = TabularEncoder(to_encode["columns"], to_encode["categorical_columns"]).fit(table)
+    # Written through a memory-mapped .npy, so the whole matrix is never in memory
+    matrix = np.lib.format.open_memmap(filepath, mode="w+", dtype=np.float32, shape=(table.shape[0], encoder.output_dim))
+    for start in range(0, table.shape[0], chunk_rows):
+        matrix[start:start + chunk_rows] = encoder.transform(table.iloc[start:start + chunk_rows])
+    matrix.flush()
+    del matrix
+    print("Data transformed")
+    return encoder
+
+
+def load_encoded_table(directory: str, key: str = None):
+    """
+    Loads an encoded table saved by save_encoded_table. The matrix is memory-mapped
+    (copy-on-write, so it can back a torch tensor without being copied) rather
+    than read into memory.
+
+    inputs:
+        - directory holding the encoded versions of one table
+        - key of the version to load, the current one when None
+
+    returns:
+        - dictionary with the key, the fitted encoder and the matrix, or None when
+          there is no such version
+    """
+    if key is None:
+        current = os.path.join(directory, "_current.json")
+        if not os.path.exists(current):
+            return None
+        with open(current) as f:
+            key = json.load(f)["key"]
+    key_dir = os.path.join(directory, key)
+    if not os.path.exists(os.path.join(key_dir, "encoder.json")):
+        return None
+    with open(os.path.join(key_dir, "encoder.json")) as f:
+        encoder = TabularEncoder.from_dict(json.load(f))
+    matrix = np.load(os.path.join(key_dir, "matrix.npy"), mmap_mode="c")
+    return {"key": key, "encoder": encoder, "matrix": matrix}
+
+
+def table_to_encode(table: pd.DataFrame, all_columns: list, cat_columns: list, chunk_rows: int = 100000) -> dict:
+    """
+    Keys a table to be encoded for SynthVAE (see encoding_key). The table is
+    encoded by its EncodedTableDataSet catalog entry when saved (see
+    save_encoded_table), and not at all when the entry already holds a table
+    with the same key; training then loads the saved matrix.
+
+    inputs:
+        - table to encode
+        - columns to encode and the categorical ones among them
+        - number of rows encoded at a time
+
+    returns:
+        - dictionary with the key, the table, its columns and categorical columns
+          and chunk_rows
+    """
+    return {
+        "key": encoding_key(table, all_columns, cat_columns),
+        "table": table,
+        "columns": list(all_columns),
+        "categorical_columns": list(cat_columns),
+        "chunk_rows": int(chunk_rows),
+    }
+
+
+def training_table_to_encode(table_one: pd.DataFrame, all_columns: list, cat_columns: list, training_input: dict) -> dict:
+    """
+    Prepares (see prepare_training_table) and keys (see table_to_encode) a
+    MIMIC-III input table for SynthVAE, to be encoded by its *_encoded catalog entry.
+    """
+    table_one = prepare_training_table(table_one, all_columns)
+    return table_to_encode(table_one, all_columns, cat_columns, training_input.get("chunk_rows", 100000))
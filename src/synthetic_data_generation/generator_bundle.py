@@ -0,0 +1,87 @@
+"""Loads and samples generator bundles written by export_generator_bundle.
+
+Only needs torch and numpy, so generation jobs can sample from a trained SynthVAE
+model without importing the training stack (pandas, the vendored opacus).
+"""
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class GeneratorBundle:
+    """A trained SynthVAE decoder and noiser (TorchScript) with the encoding spec
+    needed to decode what they generate.
+
+    Sampling follows VAE.generate_indices, so a bundle seeded like
+    sample_synthvae generates the same rows.
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): bundle directory holding generator.pt and spec.json.
+        """
+        with open(os.path.join(directory, "spec.json")) as f:
+            self.spec = json.load(f)
+        self.net = torch.jit.load(os.path.join(directory, "generator.pt"), map_location="cpu")
+        self.columns = self.spec["columns"]
+        self.categorical_columns = self.spec["categorical_columns"]
+        self.continuous_columns = self.spec["continuous_columns"]
+        self.num_categories = self.spec["num_categories"]
+        self.categories = [np.array(categories, dtype=object) for categories in self.spec["categories"]]
+        self.means = np.array(self.spec["means"], dtype=np.float64)
+        self.stds = np.array(self.spec["stds"], dtype=np.float64)
+
+    def sample(self, n_rows, seed=None):
+        """Generates n_rows rows: the category index of each categorical column,
+        shape (n_rows, categorical columns), and the standardised continuous
+        columns, shape (n_rows, continuous columns). Seeds torch's generator with
+        seed (the model's training seed when None)."""
+        torch.manual_seed(self.spec["seed"] if seed is None else seed)
+        with torch.no_grad():
+            z_samples = torch.randn((n_rows, self.spec["latent_dim"]))
+            logits, continuous, logsigma = self.net(z_samples)
+
+            category_indices = torch.zeros((n_rows, len(self.num_categories)), dtype=torch.long)
+            if sum(self.num_categories) != 0:
+                # Gumbel-max over every block at once, then an argmax per block
+                uniform = torch.rand_like(logits).clamp_(min=torch.finfo(logits.dtype).tiny)
+                perturbed = logits - torch.log(-torch.log(uniform))
+                i = 0
+                for v, width in enumerate(self.num_categories):
+                    category_indices[:, v] = perturbed[:, i : i + width].argmax(dim=1)
+                    i = i + width
+
+            if continuous.shape[1] != 0:
+                continuous = continuous + torch.exp(logsigma) * torch.randn_like(continuous)
+        return category_indices.numpy(), continuous.numpy()
+
+    def decode(self, category_indices, continuous):
+        """Decodes sampled rows into a dictionary of NumPy arrays keyed by column, in
+        the bundle's column order: categories as object arrays, continuous columns
+        un-standardised, and datetime columns (seconds since 1970) as
+        datetime64[ns]."""
+        decoded = {}
+        for block, col in enumerate(self.categorical_columns):
+            decoded[col] = self.categories[block].take(category_indices[:, block])
+
+        continuous = np.asarray(continuous, dtype=np.float64) * self.stds + self.means
+        for block, col in enumerate(self.continuous_columns):
+            if col in self.spec["datetime_columns"]:
+                # The same cast pd.to_datetime(unit='s') makes, which truncates
+                # rather than rounds to the nanosecond
+                decoded[col] = (continuous[:, block] * 1e9).astype("datetime64[ns]")
+            else:
+                decoded[col] = continuous[:, block]
+        return {col: decoded[col] for col in self.columns}
+
+    def generate(self, n_rows, seed=None):
+        """Samples and decodes n_rows rows, see sample and decode."""
+        return self.decode(*self.sample(n_rows, seed))
+
+
+def load_generator_bundle(directory):
+    """Loads a generator bundle written by export_generator_bundle."""
+    return GeneratorBundle(directory)
@@ -4,27 +4,14 @@ from kedro.pipeline import Pipeline, node
 from kedro.config import ConfigLoader
 
 from data_preparation.generate_input_training_file import *
+from data_preparation.duckdb_preprocessing import generate_input_datasets_duckdb
+from synthetic_data_generation.encoded_table import training_table_to_encode
 from synthetic_data_generation.train_generate_synthetic import *
 
 
 def load_data_pipeline(**kwargs) -> Pipeline:
     nodes = []
 
-    dl = node(
-        func=load_mimic_data,
-        inputs=None,
-        outputs=[
-            "Admissions",
-            "Chartevents",
-            "ICUstays",
-            "Items",
-            "Outputevents",
-            "Patients",
-        ],
-        name="load_mimic",
-    )
-    nodes.append(dl)
-
     ppp = node(
         func=preproc_patients,
         inputs=["Patients"],
@@ -36,54 +23,161 @@ def load_data_pipeline(**kwargs) -> Pipeline:
     return Pipeline(nodes)
 
 
-def small_preproc_pipeline(**kwargs) -> Pipeline:
+def preproc_pipeline(dataset_names: list, **kwargs) -> Pipeline:
+    """
+    Builds the input datasets named in dataset_names (keys of the dataset_tiers
+    parameters) from one shared join, chart events merge and date jitter.
+    """
 
     gen = node(
-        func=generate_11k_dataset,
-        inputs=["Admissions", "procPatients", "ICUstays", "Chartevents", "Items"],
-        outputs="table_one_11040",
-        name="generate_small_input_dataset",
+        func=partial(generate_input_datasets, dataset_names=dataset_names),
+        inputs=["Admissions", "procPatients", "ICUstays", "Chartevents", "Items", "params:dataset_tiers", "params:preprocessing_workers", "params:keyed_joins", "params:incremental_preprocessing"],
+        outputs={name: name for name in dataset_names},
+        name="generate_input_datasets",
     )
 
     return Pipeline([gen])
 
 
-def medium_preproc_pipeline(**kwargs) -> Pipeline:
+def preproc_duckdb_pipeline(dataset_names: list, **kwargs) -> Pipeline:
+    """
+    Builds the same input datasets as preproc_pipeline, selecting and joining the
+    chart events in DuckDB so CHARTEVENTS does not have to fit in memory.
+    """
 
     gen = node(
-        func=generate_81k_dataset,
-        inputs=["Admissions", "procPatients", "ICUstays", "Chartevents", "Items"],
-        outputs="table_one_imbalanced_81795",
-        name="generate_medium_input_dataset",
+        func=partial(generate_input_datasets_duckdb, dataset_names=dataset_names),
+        inputs=["Admissions", "procPatients", "ICUstays", "Items", "params:dataset_tiers", "params:keyed_joins", "params:duckdb_preprocessing"],
+        outputs={name: name for name in dataset_names},
+        name="generate_input_datasets_duckdb",
     )
 
     return Pipeline([gen])
 
 
+def small_preproc_pipeline(**kwargs) -> Pipeline:
+    return preproc_pipeline(["table_one_11040"])
+
+
+def medium_preproc_pipeline(**kwargs) -> Pipeline:
+    return preproc_pipeline(["table_one_imbalanced_81795"])
+
+
 def large_preproc_pipeline(**kwargs) -> Pipeline:
+    return preproc_pipeline(["table_one_imbalanced_217010"])
 
-    gen = node(
-        func=generate_217k_dataset,
-        inputs=["Admissions", "procPatients", "ICUstays", "Chartevents", "Items"],
-        outputs="table_one_imbalanced_217010",
-        name="generate_large_input_dataset",
+
+def train_synthetic_model_pipeline(table_size: str, **kwargs) -> Pipeline:
+    """
+    Encodes an input table, through its {table_size}_encoded catalog entry, and
+    trains SynthVAE on it, saving the model as {table_size}_model (data/06_models).
+    """
+
+    encode = node(
+        func=training_table_to_encode,
+        inputs=[
+            table_size,
+            "params:all_features",
+            "params:categorical_features",
+            "params:training_input",
+        ],
+        outputs=f"{table_size}_encoded",
+        name="training_table_to_encode",
     )
 
-    return Pipeline([gen])
+    train = node(
+        func=train_synthetic_model,
+        inputs=[f"{table_size}_encoded", "params:synthvae_training"],
+        outputs=f"{table_size}_model",
+        name="train_synthetic_model",
+    )
 
+    return Pipeline([encode, train])
 
-def generate_synthetic_input_pipeline(table_size: str, **kwargs) -> Pipeline:
+
+def generate_from_model_pipeline(table_size: str, **kwargs) -> Pipeline:
+    """
+    Generates synthetic data from the saved {table_size}_model without retraining.
+    """
 
     gen_input = node(
-        func=train_model_generate_synthetic,
+        func=generate_synthetic_data,
         inputs=[
-            table_size,
+            f"{table_size}_model",
             "params:synthetic_data_generation_size",
-            "params:all_features",
-            "params:categorical_features",
+            "params:synthetic_data_generation_seed",
         ],
         outputs="synthetic_data_input",
         name="generate_synthetic_dataset",
     )
 
     return Pipeline([gen_input])
+
+
+def stream_from_model_pipeline(table_size: str, **kwargs) -> Pipeline:
+    """
+    Generates synthetic data from the saved {table_size}_model in chunks, writing
+    it to the file set under synthetic_data_streaming.
+    """
+
+    stream = node(
+        func=stream_synthetic_data,
+        inputs=[
+            f"{table_size}_model",
+            "params:synthetic_data_generation_size",
+            "params:synthetic_data_generation_seed",
+            "params:synthetic_data_streaming",
+        ],
+        outputs=None,
+        name="stream_synthetic_dataset",
+    )
+
+    return Pipeline([stream])
+
+
+def parallel_generate_from_model_pipeline(table_size: str, **kwargs) -> Pipeline:
+    """
+    Generates synthetic data from the saved {table_size}_model in shards across
+    worker processes, writing them to the directory set under
+    synthetic_data_parallel.
+    """
+
+    generate_shards = node(
+        func=generate_synthetic_shards,
+        inputs=[
+            f"{table_size}_model",
+            "params:synthetic_data_generation_size",
+            "params:synthetic_data_generation_seed",
+            "params:synthetic_data_parallel",
+        ],
+        outputs=None,
+        name="generate_synthetic_shards",
+    )
+
+    return Pipeline([generate_shards])
+
+
+def export_generator_pipeline(table_size: str, **kwargs) -> Pipeline:
+    """
+    Exports the saved {table_size}_model as a generator bundle that can be sampled
+    with only torch and numpy (see load_generator_bundle).
+    """
+
+    export = node(
+        func=partial(export_synthetic_generator, table_name=table_size),
+        inputs=[f"{table_size}_model", "params:generator_bundles_dir"],
+        outputs=None,
+        name="export_synthetic_generator",
+    )
+
+    return Pipeline([export])
+
+
+def generate_synthetic_input_pipeline(table_size: str, **kwargs) -> Pipeline:
+
+    return Pipeline(
+        [
+            train_synthetic_model_pipeline(table_size),
+            generate_from_model_pipeline(table_size),
+        ]
+    )
@@ -19,9 +19,29 @@ def support_pipeline(**kwargs) -> Pipeline:
     )
     nodes.append(support_load)
 
+    support_encode = node(
+        func=support_demo_encode,
+        inputs="support_input_data",
+        outputs="support_input_data_encoded",
+        name="support_encode",
+    )
+    nodes.append(support_encode)
+
+    support_train = node(
+        func=support_demo_train,
+        inputs=["support_input_data_encoded", "params:synthvae_training"],
+        outputs="support_input_data_model",
+        name="support_train",
+    )
+    nodes.append(support_train)
+
     support_generate = node(
         func=support_demo_generation,
-        inputs=["support_input_data", "params:synthetic_data_generation_size"],
+        inputs=[
+            "support_input_data_model",
+            "params:synthetic_data_generation_size",
+            "params:synthetic_data_generation_seed",
+        ],
         outputs="support_synthetic_data",
         name="support_generate",
     )
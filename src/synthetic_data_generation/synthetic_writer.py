@@ -0,0 +1,54 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def write_table_chunks(chunks, filepath: str) -> int:
+    """
+    Writes DataFrame chunks to one Parquet or CSV file (picked by the file
+    extension) as they arrive, so only one chunk is held in memory at a time. The
+    file is written under a temporary name and only replaces filepath once every
+    chunk is written.
+
+    inputs:
+        - iterable of DataFrames with the same columns
+        - path of the .parquet or .csv file to write
+
+    returns:
+        - the number of rows written
+    """
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension not in (".parquet", ".csv"):
+        raise ValueError(f"Expected a .parquet or .csv file to write to, got {filepath}")
+
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    staging_file = filepath + ".tmp"
+
+    rows = 0
+    written = False
+    writer = None
+    try:
+        for chunk in chunks:
+            if extension == ".parquet":
+                if writer is None:
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    writer = pq.ParquetWriter(staging_file, table.schema)
+                else:
+                    # Later chunks take the first chunk's schema
+                    table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+                writer.write_table(table)
+            else:
+                chunk.to_csv(staging_file, mode="a" if written else "w", header=not written, index=False)
+            written = True
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if not written:
+        raise ValueError(f"No chunks to write to {filepath}")
+    os.replace(staging_file, filepath)
+    return rows
@@ -0,0 +1,312 @@
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+# For VAE dataset formatting
+from synthetic_data_generation.SynthVAE.data_loading import PoissonBatchSampler, ShuffledBatchSampler, TensorBatchLoader
+
+# VAE functions
+from synthetic_data_generation.SynthVAE.VAE import Decoder, Encoder, VAE
+
+# Other
+from data_preparation.io_utils import replace_directory
+from synthetic_data_generation.SynthVAE.utils import set_seed
+from synthetic_data_generation.tabular_encoder import TabularEncoder
+
+LATENT_DIM = 2
+
+
+def build_vae(tabular_encoder: TabularEncoder, latent_dim: int = LATENT_DIM, bf16: bool = False) -> VAE:
+    """
+    Creates an untrained VAE for tables encoded by tabular_encoder, training and
+    generating with bfloat16 autocast when bf16 is set.
+    """
+    encoder = Encoder(tabular_encoder.output_dim, latent_dim)
+    decoder = Decoder(
+        latent_dim, tabular_encoder.num_continuous, num_categories=tabular_encoder.num_categories
+    )
+    return VAE(encoder, decoder, bf16=bf16)
+
+
+def train_synthvae(encoded_table: dict, synthvae_training: dict = None) -> dict:
+    """
+    Trains SynthVAE on an encoded table, as loaded from an EncodedTableDataSet
+    (see save_encoded_table).
+
+    With a validation_fraction in synthvae_training, that share of the rows is
+    held out and the validation loss computed after every epoch (see VAE.train):
+    training stops once it has not improved by min_delta for patience epochs, the
+    best epoch's weights are kept and, with lr_schedule, the learning rate is
+    reduced by factor after lr_schedule's patience epochs without improvement.
+    None of these can be used with differential privacy (see VAE.diff_priv_train).
+
+    inputs:
+        - dictionary with the key, the fitted encoder and the matrix
+        - training settings from conf/base/parameters.yml: max_epochs,
+          validation_fraction, patience, min_delta, lr_schedule and bf16 (train, and
+          later generate, with bfloat16 autocast). Trains on every row for 30 epochs
+          in float32 when None
+
+    returns:
+        - the model: dictionary with the trained VAE, the fitted encoder, the seed
+          the VAE was trained with, the number of rows in the encoded table and its key
+    """
+    warnings.filterwarnings("ignore")
+    set_seed(0)
+
+    my_seed = np.random.randint(1e6)
+    diff_priv = False
+    synthvae_training = synthvae_training or {}
+
+    if "matrix" not in encoded_table:
+        raise ValueError(
+            f"Table {encoded_table['key']} has not been encoded: the node output needs an "
+            "EncodedTableDataSet catalog entry, which encodes the table when saving it"
+        )
+
+    # The table is one-hot encoded and standardised by save_encoded_table
+    tabular_encoder = encoded_table["encoder"]
+    x_train = np.asarray(encoded_table["matrix"], dtype=np.float32)
+
+    ###############################################################################
+    # Prepare data for interaction with torch VAE
+    # A view of the matrix, not a copy: when it is memory-mapped (see
+    # load_encoded_table) batches are read from disk as they are gathered
+    Y = torch.from_numpy(x_train)
+    batch_size = 32
+
+    # Hold out validation rows, sorted so batches read the matrix in order
+    permutation = torch.randperm(Y.shape[0], generator=torch.Generator().manual_seed(int(my_seed)))
+    validation_size = int(round(Y.shape[0] * synthvae_training.get('validation_fraction', 0.0)))
+    validation_rows = permutation[:validation_size].sort().values
+    training_rows = permutation[validation_size:].sort().values
+
+    validation_loader = None
+    if validation_size:
+        validation_loader = TensorBatchLoader(
+            Y, torch.split(torch.arange(validation_size), 1024), rows=validation_rows
+        )
+        print(f"Holding out {validation_size} rows for validation")
+
+    generator = None
+    sample_rate = batch_size / len(training_rows)
+    if diff_priv:
+        # The privacy accounting assumes Poisson sampled batches
+        batch_sampler = PoissonBatchSampler(
+            num_samples=len(training_rows), sample_rate=sample_rate, generator=generator
+        )
+    else:
+        batch_sampler = ShuffledBatchSampler(
+            num_samples=len(training_rows), batch_size=batch_size, generator=generator
+        )
+    data_loader = TensorBatchLoader(Y, batch_sampler, rows=training_rows)
+
+    target_delta = 1e-3
+    target_eps = 10.0
+
+    diff_priv_in = ""
+    if diff_priv:
+        diff_priv_in = " with differential privacy"
+
+    print(
+        f"Train VAE{diff_priv_in}"
+    )
+    set_seed(my_seed)
+
+    # Create VAE
+    vae = build_vae(tabular_encoder, bf16=bool(synthvae_training.get('bf16', False)))
+    num_epochs = int(synthvae_training.get('max_epochs', 30))
+
+    lr_scheduler = None
+    if synthvae_training.get('lr_schedule'):
+        lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+            vae.optimizer,
+            factor=synthvae_training['lr_schedule'].get('factor', 0.5),
+            patience=synthvae_training['lr_schedule'].get('patience', 2),
+        )
+    stopping = dict(
+        validation_dataloader=validation_loader,
+        patience=synthvae_training.get('patience'),
+        min_delta=synthvae_training.get('min_delta', 0.0),
+        lr_scheduler=lr_scheduler,
+    )
+    if diff_priv:
+        vae.diff_priv_train(
+            data_loader,
+            n_epochs=50,
+            C=50,
+            target_eps=target_eps,
+            target_delta=target_delta,
+            sample_rate=sample_rate,
+            **stopping,
+        )
+        print(f"(epsilon, delta): {vae.get_privacy_spent(target_delta)}")
+    else:
+        vae.train(data_loader, n_epochs=num_epochs, **stopping)
+
+    print("Training complete")
+
+    return {
+        "vae": vae,
+        "encoder": tabular_encoder,
+        "seed": int(my_seed),
+        "training_rows": int(x_train.shape[0]),
+        "encoding_key": encoded_table["key"],
+    }
+
+
+def sample_synthvae(model: dict, synthetic_data_generation_size: int, seed: int = None, datetime_columns: list = ()) -> pd.DataFrame:
+    """
+    Generates rows with a trained SynthVAE model and decodes them into a table.
+
+    inputs:
+        - the model, as returned by train_synthvae or load_synthvae_model
+        - number of rows to generate
+        - seed for the generated rows, the model's training seed when None
+        - continuous columns holding seconds since 1970, decoded as dates
+
+    returns:
+        - decoded table with the encoder's columns (see TabularEncoder.decode)
+    """
+    set_seed(model["seed"] if seed is None else seed)
+    # Only sampling, so no graph is kept for the generated rows
+    with torch.no_grad():
+        category_indices, continuous = model["vae"].generate_indices(synthetic_data_generation_size)
+
+    print("Synthetic data generated")
+
+    return model["encoder"].decode(category_indices.numpy(), continuous.numpy(), datetime_columns)
+
+
+def iter_synthvae_chunks(model: dict, synthetic_data_generation_size: int, chunk_size: int, seed: int = None, datetime_columns: list = ()):
+    """
+    Generates rows with a trained SynthVAE model chunk by chunk, so memory use
+    depends on chunk_size rather than on the number of rows generated.
+
+    inputs:
+        - the model, as returned by train_synthvae or load_synthvae_model
+        - number of rows to generate
+        - number of rows per chunk
+        - seed for the generated rows, the model's training seed when None
+        - continuous columns holding seconds since 1970, decoded as dates
+
+    returns:
+        - generator of decoded tables with the encoder's columns, of chunk_size
+          rows (the last one holds what is left)
+    """
+    set_seed(model["seed"] if seed is None else seed)
+    for start in range(0, synthetic_data_generation_size, chunk_size):
+        rows = min(chunk_size, synthetic_data_generation_size - start)
+        with torch.no_grad():
+            category_indices, continuous = model["vae"].generate_indices(rows)
+        yield model["encoder"].decode(category_indices.numpy(), continuous.numpy(), datetime_columns)
+
+
+def save_synthvae_model(directory: str, model: dict):
+    """
+    Saves a SynthVAE model as ``model.pt`` (the VAE state dict, see VAE.save) and
+    ``metadata.json`` (the fitted encoder, the VAE layout and the seed).
+
+    inputs:
+        - directory to save the model in, replaced if it exists
+        - the model, as returned by train_synthvae
+    """
+    vae = model["vae"]
+    metadata = {
+        "encoder": model["encoder"].to_dict(),
+        "latent_dim": vae.encoder.latent_dim,
+        "num_categories": [int(n) for n in vae.num_categories],
+        "num_continuous": int(vae.num_continuous),
+        "bf16": vae.bf16,
+        "seed": model["seed"],
+        "training_rows": model["training_rows"],
+        "encoding_key": model["encoding_key"],
+    }
+
+    with replace_directory(directory) as staging_dir:
+        vae.save(os.path.join(staging_dir, "model.pt"))
+        with open(os.path.join(staging_dir, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+
+
+class _GeneratorNet(nn.Module):
+    """The parts of a trained VAE used to generate rows, for tracing: maps latent
+    samples to the categorical logits, the continuous means and their log scales"""
+
+    def __init__(self, vae: VAE):
+        super().__init__()
+        self.decoder = vae.decoder
+        self.noiser = vae.noiser
+        self.num_categorical = int(sum(vae.num_categories))
+
+    def forward(self, z):
+        x_gen = self.decoder(z)
+        continuous = x_gen[:, self.num_categorical:]
+        return x_gen[:, :self.num_categorical], continuous, self.noiser(continuous)
+
+
+def export_generator_bundle(model: dict, directory: str, datetime_columns: list = ()):
+    """
+    Writes a generator bundle for a trained SynthVAE model: generator.pt, the
+    decoder and noiser traced with TorchScript, and spec.json, the encoding spec
+    (categories, means and standard deviations) and seed. Bundles are loaded with
+    load_generator_bundle, which only needs torch and numpy.
+
+    inputs:
+        - the model, as returned by train_synthvae or load_synthvae_model
+        - directory to write the bundle to, replaced if it exists
+        - continuous columns holding seconds since 1970, decoded as dates
+    """
+    vae = model["vae"]
+    tabular_encoder = model["encoder"]
+    spec = {
+        "columns": tabular_encoder.columns,
+        "categorical_columns": tabular_encoder.categorical_columns,
+        "continuous_columns": tabular_encoder.continuous_columns,
+        "categories": [categories.tolist() for categories in tabular_encoder.categories],
+        "num_categories": [int(n) for n in tabular_encoder.num_categories],
+        "means": tabular_encoder.means.tolist(),
+        "stds": tabular_encoder.stds.tolist(),
+        "datetime_columns": list(datetime_columns),
+        "latent_dim": vae.encoder.latent_dim,
+        "seed": model["seed"],
+        "encoding_key": model["encoding_key"],
+    }
+
+    # Traced in float32 whatever precision the model trains in
+    with torch.no_grad():
+        generator = torch.jit.trace(_GeneratorNet(vae).float(), torch.zeros((2, vae.encoder.latent_dim)))
+
+    with replace_directory(directory) as staging_dir:
+        generator.save(os.path.join(staging_dir, "generator.pt"))
+        with open(os.path.join(staging_dir, "spec.json"), "w") as f:
+            json.dump(spec, f)
+
+
+def load_synthvae_model(directory: str) -> dict:
+    """
+    Loads a SynthVAE model saved by save_synthvae_model.
+
+    returns:
+        - the model, as returned by train_synthvae
+    """
+    with open(os.path.join(directory, "metadata.json")) as f:
+        metadata = json.load(f)
+    tabular_encoder = TabularEncoder.from_dict(metadata["encoder"])
+    if [int(n) for n in tabular_encoder.num_categories] != metadata["num_categories"]:
+        raise ValueError(f"Encoder saved in {directory} does not match the VAE's categorical blocks")
+
+    vae = build_vae(tabular_encoder, metadata["latent_dim"], metadata.get("bf16", False))
+    vae.load(os.path.join(directory, "model.pt"))
+    return {
+        "vae": vae,
+        "encoder": tabular_encoder,
+        "seed": metadata["seed"],
+        "training_rows": metadata["training_rows"],
+        "encoding_key": metadata["encoding_key"],
+    }
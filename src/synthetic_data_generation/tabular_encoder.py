@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+
+
+class TabularEncoder:
+    """One-hot encodes the categorical columns and standardises the continuous
+    columns of a table into the float32 matrix SynthVAE trains on, and decodes
+    generated matrices back into a table.
+
+    The matrix has one one-hot block per categorical column (in the order
+    num_categories lists them) followed by the standardised continuous columns,
+    the layout the VAE's Decoder expects.
+    """
+
+    def __init__(self, columns, categorical_columns):
+        self.columns = list(columns)
+        self.declared_categorical = set(categorical_columns)
+
+    def fit(self, table: pd.DataFrame):
+        """
+        Learns the categories of each categorical column and the mean and standard
+        deviation of each continuous column.
+
+        Columns listed as categorical, and any column that is not floating point
+        (integers, booleans and strings, which rdt's HyperTransformer also one-hot
+        encoded), are one-hot encoded. Missing values are a category of their own.
+
+        inputs:
+            - table holding (at least) the encoder's columns
+
+        returns:
+            - the fitted encoder
+        """
+        self.categorical_columns = [
+            col for col in self.columns
+            if col in self.declared_categorical or table[col].dtype.kind != "f"
+        ]
+        self.continuous_columns = [col for col in self.columns if col not in self.categorical_columns]
+
+        self.categories = [pd.Index(pd.unique(table[col])) for col in self.categorical_columns]
+        self._set_layout()
+
+        continuous = table[self.continuous_columns].to_numpy(dtype=np.float64)
+        self.means = np.nanmean(continuous, axis=0) if self.num_continuous else np.zeros(0)
+        stds = np.nanstd(continuous, axis=0) if self.num_continuous else np.ones(0)
+        # As StandardScaler, constant columns are only centred
+        self.stds = np.where(stds == 0, 1.0, stds)
+        return self
+
+    def _set_layout(self):
+        self.num_categories = np.array([len(categories) for categories in self.categories], dtype=int)
+        self.num_continuous = len(self.continuous_columns)
+        # Column of the matrix each one-hot block starts at
+        self.block_offsets = np.concatenate([[0], np.cumsum(self.num_categories)[:-1]]).astype(int)
+        # For decoding: maps each block's category index to a pandas Categorical
+        # code over the non-missing categories, missing values mapping to -1
+        self.categorical_codes = []
+        for categories in self.categories:
+            missing = np.asarray(categories.isna())
+            code_map = np.cumsum(~missing) - 1
+            code_map[missing] = -1
+            self.categorical_codes.append((code_map, categories[~missing]))
+
+    @property
+    def output_dim(self) -> int:
+        return int(self.num_categories.sum()) + self.num_continuous
+
+    def transform(self, table: pd.DataFrame) -> np.ndarray:
+        """
+        Encodes a table into the training matrix. Missing continuous values are
+        set to the column mean (0 once standardised).
+
+        inputs:
+            - table holding (at least) the encoder's columns
+
+        returns:
+            - float32 matrix of shape (rows, output_dim)
+        """
+        n_rows = table.shape[0]
+        matrix = np.zeros((n_rows, self.output_dim), dtype=np.float32)
+
+        if len(self.categorical_columns):
+            codes = np.empty((n_rows, len(self.categorical_columns)), dtype=np.int64)
+            for block, (col, categories) in enumerate(zip(self.categorical_columns, self.categories)):
+                codes[:, block] = categories.get_indexer(table[col])
+            if (codes < 0).any():
+                unknown = [col for block, col in enumerate(self.categorical_columns) if (codes[:, block] < 0).any()]
+                raise ValueError(f"Categories not seen when fitting the encoder in columns: {unknown}")
+            # Every one-hot entry of every block is set in one scatter
+            matrix[np.arange(n_rows)[:, None], codes + self.block_offsets] = 1.0
+
+        if self.num_continuous:
+            continuous = table[self.continuous_columns].to_numpy(dtype=np.float64)
+            standardised = (continuous - self.means) / self.stds
+            matrix[:, -self.num_continuous:] = np.nan_to_num(standardised, nan=0.0)
+        return matrix
+
+    def fit_transform(self, table: pd.DataFrame) -> np.ndarray:
+        return self.fit(table).transform(table)
+
+    def inverse_transform(self, matrix: np.ndarray) -> pd.DataFrame:
+        """
+        Decodes a matrix in the training layout (e.g. generated by the VAE) back
+        into a table with the encoder's columns. Each categorical column takes the
+        category with the largest entry in its block.
+
+        inputs:
+            - matrix of shape (rows, output_dim)
+
+        returns:
+            - decoded table
+        """
+        matrix = np.asarray(matrix)
+        codes = np.empty((matrix.shape[0], len(self.categorical_columns)), dtype=np.int64)
+        for block, (offset, width) in enumerate(zip(self.block_offsets, self.num_categories)):
+            codes[:, block] = matrix[:, offset:offset + width].argmax(axis=1)
+        return self.decode(codes, matrix[:, matrix.shape[1] - self.num_continuous:])
+
+    def decode(self, codes: np.ndarray, continuous: np.ndarray, datetime_columns: list = ()) -> pd.DataFrame:
+        """
+        Decodes category indices and standardised continuous values (e.g. from
+        VAE.generate_indices) into a table with the encoder's columns, without going
+        through the one-hot matrix. Categorical columns are built as pandas
+        Categoricals straight from the indices (the missing value category becomes
+        NaN) and the continuous columns are un-standardised in one operation.
+
+        inputs:
+            - index of the category of each categorical column, shape (rows, categorical columns)
+            - standardised continuous columns, shape (rows, continuous columns)
+            - continuous columns holding seconds since 1970, returned as dates
+
+        returns:
+            - decoded table
+        """
+        codes = np.asarray(codes)
+        decoded = {}
+        for block, (col, (code_map, categories)) in enumerate(zip(self.categorical_columns, self.categorical_codes)):
+            decoded[col] = pd.Categorical.from_codes(code_map[codes[:, block]], categories=categories)
+
+        if self.num_continuous:
+            continuous = np.asarray(continuous, dtype=np.float64) * self.stds + self.means
+            for block, col in enumerate(self.continuous_columns):
+                if col in datetime_columns:
+                    decoded[col] = pd.to_datetime(continuous[:, block], unit='s', origin='unix').to_numpy()
+                else:
+                    decoded[col] = continuous[:, block]
+
+        return pd.DataFrame(decoded, columns=self.columns)
+
+    def to_dict(self) -> dict:
+        """
+        Describes the fitted encoder with JSON-serialisable values, see from_dict.
+        """
+        return {
+            "columns": self.columns,
+            "declared_categorical": sorted(self.declared_categorical),
+            "categorical_columns": self.categorical_columns,
+            "continuous_columns": self.continuous_columns,
+            "categories": [categories.tolist() for categories in self.categories],
+            "means": self.means.tolist(),
+            "stds": self.stds.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict):
+        """
+        Rebuilds a fitted encoder from the output of to_dict.
+        """
+        encoder = cls(state["columns"], state["declared_categorical"])
+        encoder.categorical_columns = state["categorical_columns"]
+        encoder.continuous_columns = state["continuous_columns"]
+        encoder.categories = [pd.Index(categories) for categories in state["categories"]]
+        encoder._set_layout()
+        encoder.means = np.array(state["means"], dtype=np.float64)
+        encoder.stds = np.array(state["stds"], dtype=np.float64)
+        return encoder
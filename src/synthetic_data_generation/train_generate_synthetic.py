@@ -1,163 +1,217 @@
-from re import S
-import warnings
-from xmlrpc.client import Boolean
 # Standard imports
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 import torch
 
-# For data preprocessing
-from rdt import HyperTransformer
-from sklearn.preprocessing import StandardScaler
-from sklearn_pandas import DataFrameMapper
-
-from synthetic_data_generation.SynthVAE.opacus.utils.uniform_sampler import UniformWithReplacementSampler
-
-# For VAE dataset formatting
-from torch.utils.data import TensorDataset, DataLoader
-
-# VAE functions
-from synthetic_data_generation.SynthVAE.VAE import Decoder, Encoder, VAE
-
-# Other
-from synthetic_data_generation.SynthVAE.utils import set_seed
-
-def train_model_generate_synthetic(table_one: pd.DataFrame, synthetic_data_generation_size: int,
-                                    all_columns: list, cat_columns: list) -> pd.DataFrame:
-
-
-    warnings.filterwarnings("ignore")
-    set_seed(0)
-
-    my_seed = np.random.randint(1e6)
-    diff_priv = False
-
-    table_one['SUBJECT_ID'] = table_one['SUBJECT_ID'].astype(float)
-    table_one['ADMITTIME'] = pd.to_datetime(table_one['ADMITTIME'])
-    table_one = table_one[(table_one['ADMITTIME']>pd.Timestamp("1970-01-01"))]
-    table_one['ADMITTIME'] = (table_one['ADMITTIME'] - pd.Timestamp("1970-01-01")) // pd.Timedelta('1s')
-    table_one['ADMITTIME'] = table_one['ADMITTIME'].astype(float)
-    table_one['age'] = np.abs(table_one['age'])
-
-    # Explicitly type the categorical variables of the SUPPORT dataset
-    table_cols = all_columns
-    table_one = table_one[table_cols]
-    ###############################################################################
-    # DATA PREPROCESSING #
-    # We one-hot the categorical cols and standardise the continuous cols
-    print("Beginning data preprocessing")
-
-    cat_cols = cat_columns
-    cont_cols = list(set(all_columns)-set(cat_columns))
-
-    transformer_dtypes = {
-        "i": "one_hot_encoding",
-        "f": "numerical",
-        "O": "one_hot_encoding",
-        "b": "one_hot_encoding",
-        "M": "datetime",
-    }
-    ht = HyperTransformer(dtype_transformers=transformer_dtypes)
-    ht.fit(table_one)
-    transformed = ht.transform(table_one)
-
-    print("Data transformed")
-    num_categories = (
-        np.array([len(table_one[col].unique()) for col in cat_cols])
-    ).astype(int)
-    num_continuous = len(cont_cols)
-    cols_standardize = transformed.columns[0:num_continuous]
-    cols_leave = transformed.columns[num_continuous:]
-    standardize = [([col], StandardScaler()) for col in cols_standardize]
-    leave = [([col], None) for col in cols_leave]
-    x_mapper = DataFrameMapper(leave + standardize)
-    x_train_df = x_mapper.fit_transform(transformed)
-    x_train_df = x_mapper.transform(transformed)
-    x_train = x_train_df.astype("float32")
-
-
-    ###############################################################################
-    # Prepare data for interaction with torch VAE
-    Y = torch.Tensor(x_train)
-    dataset = TensorDataset(Y)
-    batch_size = 32
-
-    generator = None
-    sample_rate = batch_size / len(dataset)
-    data_loader = DataLoader(
-        dataset,
-        batch_sampler=UniformWithReplacementSampler(
-            num_samples=len(dataset), sample_rate=sample_rate, generator=generator
-        ),
-        pin_memory=True,
-        generator=generator,
-    )
-
-    target_delta = 1e-3
-    target_eps = 10.0
-
-    diff_priv_in = ""
-    if diff_priv:
-        diff_priv_in = " with differential privacy"
-
-    print(
-        f"Train + Generate + Evaluate VAE{diff_priv_in}"
-    )
-    set_seed(my_seed)
-
-    # Create VAE
-    latent_dim = 2
-    encoder = Encoder(x_train.shape[1], latent_dim)
-    decoder = Decoder(
-        latent_dim, num_continuous, num_categories=num_categories
-    )
-    vae = VAE(encoder, decoder)
-    num_epochs = 30
-    if diff_priv:
-        vae.diff_priv_train(
-            data_loader,
-            n_epochs=50,
-            C=50,
-            target_eps=target_eps,
-            target_delta=target_delta,
-            sample_rate=sample_rate,
-        )
-        print(f"(epsilon, delta): {vae.get_privacy_spent(target_delta)}")
-    else:
-        vae.train(data_loader, n_epochs=num_epochs)
-
-    print("Training complete, producing synthetic data")
-
-    samples_ = vae.generate(synthetic_data_generation_size).detach().numpy()
-
-    print("Synthetic data generated")
-
-    samples = np.ones_like(samples_)
-    samples[:, :num_continuous] = samples_[:, -num_continuous:]
-    samples[:, num_continuous:] = samples_[:, :-num_continuous]
-    samples = pd.DataFrame(samples)
-    samples.columns = transformed.columns
-    samples = ht.reverse_transform(samples)
-    samples[cat_cols] = samples[cat_cols].astype(object)
-
-
-    for feature in x_mapper.features:
-        if feature[0][0] in cont_cols:
-            f = feature[0][0]
-            samples[f] = feature[1].inverse_transform(samples[f])
+from data_preparation.io_utils import replace_directory
 
-    print("Saving down synthetic data")
-    samples['ROW_ID'] = np.arange(samples.shape[0])
+# SynthVAE training, sampling and model artifacts
+from synthetic_data_generation.synthvae_model import export_generator_bundle, iter_synthvae_chunks, sample_synthvae, train_synthvae
+from synthetic_data_generation.synthetic_writer import write_table_chunks
+
+# Continuous columns of the MIMIC-III input tables encoded as seconds since 1970
+DATETIME_COLUMNS = ['ADMITTIME']
+
+
+def train_synthetic_model(encoded_table: dict, synthvae_training: dict) -> dict:
+    """
+    Trains SynthVAE on an encoded MIMIC-III input table. The returned model is
+    saved to data/06_models by its catalog entry, so synthetic data can be
+    generated from it any number of times without retraining.
+
+    inputs:
+        - encoded input table, loaded from its *_encoded catalog entry (see
+          training_table_to_encode)
+        - training settings from conf/base/parameters.yml (see train_synthvae)
+
+    returns:
+        - the trained model (see train_synthvae)
+    """
+    return train_synthvae(encoded_table, synthvae_training)
+
+
+def export_synthetic_generator(model: dict, generator_bundles_dir: str, table_name: str):
+    """
+    Exports a trained SynthVAE model as a generator bundle in
+    generator_bundles_dir/table_name (see export_generator_bundle), for generation
+    jobs that should not import the training stack.
+
+    inputs:
+        - the trained model (see train_synthetic_model)
+        - directory generator bundles are saved in, from conf/base/parameters.yml
+        - name of the input table the model was trained on
+    """
+    directory = os.path.join(generator_bundles_dir, table_name)
+    export_generator_bundle(model, directory, DATETIME_COLUMNS)
+    print(f"Saved generator bundle to {directory}")
+
+
+def finish_synthetic_rows(samples: pd.DataFrame, all_columns: list, first_row_id: int = 0) -> pd.DataFrame:
+    """
+    Numbers generated rows from first_row_id and rounds SUBJECT_ID.
+    """
+    samples['ROW_ID'] = np.arange(first_row_id, first_row_id + samples.shape[0])
     samples['SUBJECT_ID'] = np.round(samples['SUBJECT_ID'],0)
-    samples['ADMITTIME'] = pd.to_datetime(samples['ADMITTIME'], unit='s', origin='unix') 
     final_column_names = ['ROW_ID'] + all_columns
-    samples_final = samples[final_column_names]
-    
-    
-    if (table_one.shape[0]) < 75000:
+    return samples[final_column_names]
+
+
+def generate_synthetic_data(model: dict, synthetic_data_generation_size: int, synthetic_data_generation_seed: int = None) -> pd.DataFrame:
+    """
+    Generates a synthetic MIMIC-III input table from a trained SynthVAE model.
+
+    inputs:
+        - the trained model (see train_synthetic_model)
+        - number of rows to generate
+        - seed for the generated rows, the model's training seed when None
+
+    returns:
+        - the synthetic table, also written to data/07_model_output
+    """
+    samples = sample_synthvae(model, synthetic_data_generation_size, synthetic_data_generation_seed, DATETIME_COLUMNS)
+    training_rows = model["training_rows"]
+
+    print("Saving down synthetic data")
+    samples_final = finish_synthetic_rows(samples, model["encoder"].columns)
+    # The evaluation checks compare these columns with the real data's object columns
+    samples_final = samples_final.astype(dict.fromkeys(model["encoder"].categorical_columns, object))
+
+    if training_rows < 75000:
         samples_final.to_csv(f'data/07_model_output/synthetic_data_small_input.csv',index=False)
-    elif (table_one.shape[0]) < 125000:
+    elif training_rows < 125000:
         samples_final.to_csv(f'data/07_model_output/synthetic_data_medium_input.csv',index=False)
-    elif (table_one.shape[0]) < 200000:
+    elif training_rows < 200000:
         samples_final.to_csv(f'data/07_model_output/synthetic_data_large_input.csv',index=False)
-    return samples_final
\ No newline at end of file
+    return samples_final
+
+
+def stream_synthetic_data(model: dict, synthetic_data_generation_size: int, synthetic_data_generation_seed: int, synthetic_data_streaming: dict):
+    """
+    Generates a synthetic MIMIC-III input table from a trained SynthVAE model in
+    chunks, appending each chunk to a Parquet or CSV file as it is generated, so
+    memory use stays flat however many rows are asked for.
+
+    inputs:
+        - the trained model (see train_synthetic_model)
+        - number of rows to generate
+        - seed for the generated rows, the model's training seed when None
+        - streaming settings from conf/base/parameters.yml: the number of rows per
+          chunk and the .parquet or .csv file to write
+    """
+    all_columns = model["encoder"].columns
+    chunk_size = int(synthetic_data_streaming['chunk_size'])
+    filepath = synthetic_data_streaming['filepath']
+
+    def finished_chunks():
+        first_row_id = 0
+        for samples in iter_synthvae_chunks(model, synthetic_data_generation_size, chunk_size, synthetic_data_generation_seed, DATETIME_COLUMNS):
+            yield finish_synthetic_rows(samples, all_columns, first_row_id)
+            first_row_id += samples.shape[0]
+
+    rows = write_table_chunks(finished_chunks(), filepath)
+    print(f"Saved {rows} synthetic rows to {filepath}")
+
+
+def shard_seed(base_seed: int, shard: int) -> int:
+    """
+    Derives the seed of one shard of generated rows from the base seed and the
+    shard number, so each shard has its own random stream.
+    """
+    return int(np.random.SeedSequence([base_seed, shard]).generate_state(1)[0])
+
+
+_worker_model = None
+
+
+def _set_worker_model(model: dict):
+    global _worker_model
+    _worker_model = model
+    # One thread per worker, so workers do not compete for cores
+    torch.set_num_threads(1)
+
+
+def _write_synthetic_shard(model: dict, rows: int, first_row_id: int, seed: int, chunk_size: int, filepath: str) -> int:
+    all_columns = model["encoder"].columns
+
+    def finished_chunks():
+        row_id = first_row_id
+        for samples in iter_synthvae_chunks(model, rows, chunk_size, seed, DATETIME_COLUMNS):
+            yield finish_synthetic_rows(samples, all_columns, row_id)
+            row_id += samples.shape[0]
+
+    return write_table_chunks(finished_chunks(), filepath)
+
+
+def _write_synthetic_shard_in_worker(rows: int, first_row_id: int, seed: int, chunk_size: int, filepath: str) -> int:
+    return _write_synthetic_shard(_worker_model, rows, first_row_id, seed, chunk_size, filepath)
+
+
+def generate_synthetic_shards(model: dict, synthetic_data_generation_size: int, synthetic_data_generation_seed: int, synthetic_data_parallel: dict):
+    """
+    Generates a synthetic MIMIC-III input table from a trained SynthVAE model in
+    shards of shard_size rows, across worker processes. Shard i is generated with
+    a seed derived from the base seed and i and written to part-<i>.<format>, so
+    the files are the same whatever the number of workers. A _manifest.json lists
+    the shards, their rows, first ROW_ID and seed.
+
+    inputs:
+        - the trained model (see train_synthetic_model)
+        - number of rows to generate
+        - base seed, the model's training seed when None
+        - parallel generation settings from conf/base/parameters.yml: the number of
+          workers, rows per shard and per chunk, the directory to write the shards
+          to (replaced if it exists) and the file format (parquet or csv)
+    """
+    base_seed = model["seed"] if synthetic_data_generation_seed is None else synthetic_data_generation_seed
+    shard_size = int(synthetic_data_parallel['shard_size'])
+    chunk_size = int(synthetic_data_parallel['chunk_size'])
+    workers = int(synthetic_data_parallel['workers'])
+    output_dir = synthetic_data_parallel['output_dir'].rstrip('/')
+    file_format = synthetic_data_parallel.get('format', 'parquet')
+
+    with replace_directory(output_dir) as staging_dir:
+        shards = []
+        for shard, first_row_id in enumerate(range(0, synthetic_data_generation_size, shard_size)):
+            shards.append({
+                'file': f'part-{shard:05d}.{file_format}',
+                'rows': min(shard_size, synthetic_data_generation_size - first_row_id),
+                'first_row_id': first_row_id,
+                'seed': shard_seed(base_seed, shard),
+            })
+        print(f"Generating {synthetic_data_generation_size} synthetic rows in {len(shards)} shards")
+
+        shard_args = [
+            (shard['rows'], shard['first_row_id'], shard['seed'], chunk_size, os.path.join(staging_dir, shard['file']))
+            for shard in shards
+        ]
+        if workers <= 1:
+            threads = torch.get_num_threads()
+            torch.set_num_threads(1)
+            try:
+                for args in shard_args:
+                    _write_synthetic_shard(model, *args)
+            finally:
+                torch.set_num_threads(threads)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_set_worker_model, initargs=(model,)) as executor:
+                futures = [executor.submit(_write_synthetic_shard_in_worker, *args) for args in shard_args]
+                for future in futures:
+                    future.result()
+
+        manifest = {
+            'rows': synthetic_data_generation_size,
+            'base_seed': base_seed,
+            'shard_size': shard_size,
+            'chunk_size': chunk_size,
+            'encoding_key': model["encoding_key"],
+            'columns': ['ROW_ID'] + model["encoder"].columns,
+            'shards': shards,
+        }
+        with open(os.path.join(staging_dir, '_manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    print(f"Saved {len(shards)} shards of synthetic data to {output_dir}")
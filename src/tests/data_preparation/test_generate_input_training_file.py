@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_preparation.generate_input_training_file import (
+    generate_input_datasets,
+    preproc_patients,
+    select_dataset_events,
+)
+
+DATASET_TIERS = {
+    'table_one_11040': {'events_per_stay': 1, 'rows_per_subject': 4},
+    'table_one_imbalanced_81795': {'subject_splits': [0.3, 0.9], 'events_per_tier': [1, 2, 100]},
+}
+
+
+def make_chartevents(rows=2000, subjects=150, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'SUBJECT_ID': rng.integers(1, subjects * 7, subjects)[rng.integers(0, subjects, rows)],
+        'ICUSTAY_ID': rng.integers(200000, 200020, rows),
+        'ITEMID': rng.integers(1, 50, rows),
+        'VALUE': rng.normal(size=rows),
+    })
+
+
+def reference_tier_sample(chartevents, subject_splits, events_per_tier):
+    # The per-subject loop the tiered sampler replaced
+    total_subjects = list(chartevents.SUBJECT_ID.unique())
+    splits = [int(np.round(len(total_subjects)*split,0)) for split in subject_splits]
+    starts = [0] + splits
+    ends = splits + [len(total_subjects)]
+    df_list = []
+    for start, end, events in zip(starts, ends, events_per_tier):
+        for sub_index in range(start, end):
+            search_id = total_subjects[sub_index]
+            df_list.append(chartevents[chartevents.SUBJECT_ID == int(search_id)].head(events))
+    return pd.concat(df_list)
+
+
+@pytest.mark.parametrize("subject_splits, events_per_tier", [
+    ((0.3, 0.9), (1, 2, 100)),
+    ((0.3, 0.7), (1, 2, 100)),
+    ((0.5,), (3, 1)),
+])
+def test_tier_sample_matches_per_subject_loop(subject_splits, events_per_tier):
+    chartevents = make_chartevents()
+    keep = select_dataset_events(chartevents, {'subject_splits': subject_splits, 'events_per_tier': events_per_tier})
+    expected = reference_tier_sample(chartevents, subject_splits, events_per_tier)
+    pd.testing.assert_frame_equal(chartevents[keep], expected.sort_index())
+
+
+def test_events_per_stay_matches_drop_duplicates():
+    chartevents = make_chartevents()
+    keep = select_dataset_events(chartevents, {'events_per_stay': 1})
+    expected = chartevents.drop_duplicates(subset=['SUBJECT_ID','ICUSTAY_ID'])
+    pd.testing.assert_frame_equal(chartevents[keep], expected)
+
+
+def make_raw_tables(subject_ids, seed=0):
+    rng = np.random.default_rng(seed)
+    fmt = '%Y-%m-%d %H:%M:%S'
+    subjects = len(subject_ids)
+    dob = pd.to_datetime(rng.integers(pd.Timestamp('1850-01-01').value, pd.Timestamp('2100-01-01').value, subjects))
+    patients = pd.DataFrame({'SUBJECT_ID': subject_ids, 'GENDER': rng.choice(['M','F'], subjects), 'DOB': dob.floor('h').strftime(fmt)})
+
+    admission_subjects = np.repeat(subject_ids, rng.integers(1, 3, subjects))
+    admit = pd.Timestamp('2100-01-01') + pd.to_timedelta(rng.integers(0, 3e8, len(admission_subjects)), unit='s')
+    admissions = pd.DataFrame({
+        'ROW_ID': np.arange(len(admission_subjects)),
+        'SUBJECT_ID': admission_subjects,
+        'HADM_ID': 100000 + np.arange(len(admission_subjects)),
+        'ETHNICITY': rng.choice(['WHITE','BLACK','ASIAN'], len(admission_subjects)),
+        'ADMITTIME': admit.strftime(fmt),
+        'DISCHTIME': (admit + pd.to_timedelta(rng.integers(3600, 30*86400, len(admission_subjects)), unit='s')).strftime(fmt),
+        'DISCHARGE_LOCATION': rng.choice(['HOME','SNF'], len(admission_subjects)),
+    })
+    stays = admissions.loc[np.repeat(admissions.index, rng.integers(1, 3, len(admissions))), ['SUBJECT_ID','HADM_ID']]
+    icustays = stays.assign(
+        ICUSTAY_ID=200000 + np.arange(len(stays)), FIRST_CAREUNIT=rng.choice(['MICU','CCU'], len(stays))
+    ).reset_index(drop=True)
+
+    # CHARTTIME is redrawn by the date jitter
+    events = icustays.iloc[rng.integers(0, len(icustays), subjects * 40)].reset_index(drop=True)
+    chartevents = pd.DataFrame({
+        'SUBJECT_ID': events['SUBJECT_ID'],
+        'ICUSTAY_ID': events['ICUSTAY_ID'],
+        'CHARTTIME': '2100-01-01 00:00:00',
+        'ITEMID': rng.integers(200, 230, len(events)),
+        'VALUE': rng.choice(['12','Normal','7.4'], len(events)),
+        'VALUEUOM': rng.choice(['mmHg','%'], len(events)),
+    })
+    items = pd.DataFrame({'ITEMID': np.arange(200, 225), 'LABEL': [f'item {i}' for i in range(25)]})
+    return admissions, patients, icustays, chartevents, items
+
+
+def build_datasets(raw_tables, preprocessing_workers, incremental_preprocessing=None):
+    admissions, patients, icustays, chartevents, items = raw_tables
+    return generate_input_datasets(
+        admissions, preproc_patients(patients.copy()), icustays, chartevents, items,
+        DATASET_TIERS, preprocessing_workers, True, incremental_preprocessing or {}, list(DATASET_TIERS),
+    )
+
+
+def only_subjects(raw_tables, subject_ids):
+    *subject_tables, items = raw_tables
+    return [table[table['SUBJECT_ID'].isin(subject_ids)] for table in subject_tables] + [items]
+
+
+@pytest.mark.parametrize("subject_ids", [
+    np.arange(1, 121) * 3,
+    # Few subjects, all with the same ID modulo 3, so some shards are empty
+    np.array([1, 4, 7]),
+])
+def test_input_datasets_same_for_any_number_of_workers(subject_ids):
+    raw_tables = make_raw_tables(subject_ids)
+    single = build_datasets(raw_tables, 1)
+    assert all(len(dataset) for dataset in single.values())
+    for workers in (3, 4):
+        sharded = build_datasets(raw_tables, workers)
+        for name in DATASET_TIERS:
+            pd.testing.assert_frame_equal(sharded[name], single[name])
+
+
+def test_incremental_build_matches_full_build(tmp_path):
+    incremental_preprocessing = {'enabled': True, 'state_dir': str(tmp_path)}
+    subject_ids = np.arange(1, 121) * 3
+    raw_tables = make_raw_tables(subject_ids)
+
+    first = only_subjects(raw_tables, subject_ids[:100])
+    for name, dataset in build_datasets(first, 1, incremental_preprocessing).items():
+        pd.testing.assert_frame_equal(dataset, build_datasets(first, 1)[name])
+
+    # New subjects (which also move subjects between tiers), a removed subject
+    # and a changed chart event
+    second = only_subjects(raw_tables, np.delete(subject_ids, 7))
+    chartevents = second[3].copy()
+    chartevents.iloc[0, chartevents.columns.get_loc('VALUE')] = 'changed'
+    second[3] = chartevents
+    incremental = build_datasets(second, 2, incremental_preprocessing)
+    full = build_datasets(second, 1)
+    for name in DATASET_TIERS:
+        pd.testing.assert_frame_equal(incremental[name], full[name])
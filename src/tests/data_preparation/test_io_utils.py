@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from data_preparation.io_utils import replace_directory
+
+
+def write_version(directory, version):
+    with replace_directory(directory) as staging_dir:
+        with open(os.path.join(staging_dir, 'version'), 'w') as f:
+            f.write(version)
+
+
+def read_version(directory):
+    with open(os.path.join(directory, 'version')) as f:
+        return f.read()
+
+
+def test_replace_directory_swaps_in_new_version(tmp_path):
+    directory = str(tmp_path / 'table')
+    write_version(directory, 'first')
+    write_version(directory, 'second')
+    assert read_version(directory) == 'second'
+    assert sorted(os.listdir(tmp_path)) == ['table']
+
+
+def test_failed_write_keeps_old_version(tmp_path):
+    directory = str(tmp_path / 'table')
+    write_version(directory, 'first')
+    with pytest.raises(RuntimeError):
+        with replace_directory(directory):
+            raise RuntimeError('crashed while writing')
+    assert read_version(directory) == 'first'
+    assert sorted(os.listdir(tmp_path)) == ['table']
+
+
+def test_crash_between_renames_is_recovered(tmp_path):
+    directory = str(tmp_path / 'table')
+    write_version(directory, 'first')
+    # The state a crash after renaming the old version aside leaves behind
+    os.rename(directory, directory + '.old')
+    with pytest.raises(RuntimeError):
+        with replace_directory(directory):
+            raise RuntimeError('crashed while writing')
+    assert read_version(directory) == 'first'
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import torch
+from torch.distributions.normal import Normal
+
+from synthetic_data_generation.SynthVAE.data_loading import TensorBatchLoader
+from synthetic_data_generation.SynthVAE.VAE import VAE, Decoder, Encoder
+
+NUM_CATEGORIES = [3, 1, 7, 2, 5]
+NUM_CONTINUOUS = 4
+
+
+def make_vae():
+    torch.manual_seed(0)
+    input_dim = sum(NUM_CATEGORIES) + NUM_CONTINUOUS
+    return VAE(Encoder(input_dim, 2), Decoder(2, NUM_CONTINUOUS, num_categories=np.array(NUM_CATEGORIES)))
+
+
+def make_rows(rows):
+    blocks = [torch.nn.functional.one_hot(torch.randint(n, (rows,)), n).float() for n in NUM_CATEGORIES]
+    return torch.cat(blocks + [torch.randn(rows, NUM_CONTINUOUS)], dim=1)
+
+
+def reference_loss(vae, X):
+    # The per-block loss the fused VAE.loss replaced
+    mu_z, logsigma_z = vae.encoder(X)
+
+    p = Normal(torch.zeros_like(mu_z), torch.ones_like(mu_z))
+    q = Normal(mu_z, torch.exp(logsigma_z))
+
+    encoder_loss = torch.sum(torch.distributions.kl_divergence(q, p))
+
+    s = torch.randn_like(mu_z)
+    z_samples = mu_z + s * torch.exp(logsigma_z)
+
+    x_recon = vae.decoder(z_samples)
+
+    categoric_loglik = 0
+    i = 0
+    for v in range(len(vae.num_categories)):
+        categoric_loglik += -torch.nn.functional.cross_entropy(
+            x_recon[:, i : (i + vae.num_categories[v])],
+            torch.max(X[:, i : (i + vae.num_categories[v])], 1)[1],
+        ).sum()
+        i = i + vae.decoder.num_categories[v]
+
+    gauss_loglik = (
+        Normal(
+            loc=x_recon[:, -vae.num_continuous :],
+            scale=torch.exp(vae.noiser(x_recon[:, -vae.num_continuous :])),
+        )
+        .log_prob(X[:, -vae.num_continuous :])
+        .sum()
+    )
+
+    return encoder_loss - (categoric_loglik + gauss_loglik)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float64])
+def test_loss_matches_per_block_loss(dtype):
+    vae = make_vae().to(dtype)
+    X = make_rows(64).to(dtype)
+
+    torch.manual_seed(1)
+    loss = vae.loss(X)
+    loss.backward()
+    gradients = [p.grad.clone() for p in vae.parameters() if p.requires_grad]
+    vae.zero_grad()
+
+    torch.manual_seed(1)
+    expected = reference_loss(vae, X)
+    expected.backward()
+    expected_gradients = [p.grad for p in vae.parameters() if p.requires_grad]
+
+    torch.testing.assert_close(loss, expected)
+    for gradient, expected_gradient in zip(gradients, expected_gradients):
+        torch.testing.assert_close(gradient, expected_gradient)
+
+
+def test_validation_loss_does_not_depend_on_batch_size():
+    vae = make_vae()
+    # A posterior scale of exp(-30) makes the latent samples, and so the loss, the
+    # same however the rows are batched
+    with torch.no_grad():
+        vae.encoder.net[-1].weight[2:] = 0.0
+        vae.encoder.net[-1].bias[2:] = -30.0
+    X = make_rows(2000)
+
+    losses = [
+        vae.validation_loss(TensorBatchLoader(X, torch.split(torch.arange(X.shape[0]), batch_size)))
+        for batch_size in (1, 32, 1024, 2000)
+    ]
+    for loss in losses[:-1]:
+        assert loss == pytest.approx(losses[-1], rel=1e-5)
+
+
+@pytest.mark.parametrize("stopping", ["validation_dataloader", "patience", "lr_scheduler"])
+def test_diff_priv_train_rejects_model_selection(stopping):
+    vae = make_vae()
+    X = make_rows(64)
+    loader = TensorBatchLoader(X, torch.split(torch.arange(64), 32))
+    kwargs = {
+        "validation_dataloader": {"validation_dataloader": loader},
+        "patience": {"patience": 3},
+        "lr_scheduler": {"lr_scheduler": torch.optim.lr_scheduler.ReduceLROnPlateau(vae.optimizer)},
+    }[stopping]
+    with pytest.raises(ValueError):
+        vae.diff_priv_train(loader, 1, C=50, target_eps=10, target_delta=1e-3, sample_rate=0.5, **kwargs)
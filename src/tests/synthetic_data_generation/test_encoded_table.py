@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from synthetic_data_generation import encoded_table
+from synthetic_data_generation.encoded_table import load_encoded_table, save_encoded_table, table_to_encode
+from synthetic_data_generation.tabular_encoder import TabularEncoder
+
+
+def make_table(rows=250, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'GENDER': rng.choice(['M', 'F'], rows),
+        'LABEL': rng.choice(['item 1', 'item 2', 'item 3'], rows),
+        'age': rng.normal(60, 15, rows),
+    })
+
+
+def test_saved_matrix_matches_encoder(tmp_path):
+    table = make_table()
+    save_encoded_table(str(tmp_path), table_to_encode(table, list(table.columns), ['GENDER', 'LABEL'], chunk_rows=64))
+    encoded = load_encoded_table(str(tmp_path))
+    expected = TabularEncoder(list(table.columns), ['GENDER', 'LABEL']).fit(table).transform(table)
+    np.testing.assert_array_equal(encoded['matrix'], expected)
+
+
+def test_saving_same_table_again_skips_encoding(tmp_path, monkeypatch):
+    table = make_table()
+    save_encoded_table(str(tmp_path), table_to_encode(table, list(table.columns), ['GENDER', 'LABEL']))
+    key = load_encoded_table(str(tmp_path))['key']
+
+    def fail(*args):
+        raise AssertionError('table encoded again')
+
+    monkeypatch.setattr(encoded_table, '_write_encoded_matrix', fail)
+    save_encoded_table(str(tmp_path), table_to_encode(table.copy(), list(table.columns), ['GENDER', 'LABEL']))
+    assert load_encoded_table(str(tmp_path))['key'] == key
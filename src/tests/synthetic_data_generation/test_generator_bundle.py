@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+
+from synthetic_data_generation.generator_bundle import GeneratorBundle
+
+
+def make_date_bundle():
+    # decode only needs the spec, not the TorchScript generator
+    bundle = GeneratorBundle.__new__(GeneratorBundle)
+    bundle.spec = {"datetime_columns": ["ADMITTIME"]}
+    bundle.columns = bundle.continuous_columns = ["ADMITTIME"]
+    bundle.categorical_columns = []
+    bundle.means = np.array([1e9])
+    bundle.stds = np.array([1e9])
+    return bundle
+
+
+def test_decoded_dates_match_pandas_conversion():
+    continuous = np.random.default_rng(0).normal(size=(200000, 1))
+    decoded = make_date_bundle().decode(np.zeros((len(continuous), 0), dtype=np.int64), continuous)
+    expected = pd.to_datetime(continuous[:, 0] * 1e9 + 1e9, unit='s', origin='unix').to_numpy()
+    np.testing.assert_array_equal(decoded["ADMITTIME"], expected)